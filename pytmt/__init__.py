@@ -4,3 +4,7 @@
 
 __version_info__ = ('0', '5', '0')
 __version__ = '.'.join(__version_info__)
+
+from pytmt.api import quantify  # noqa: E402
+
+__all__ = ['quantify', '__version__']
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+""" Library interface: quantifies psms held in memory and returns the result tables """
+
+import logging
+import os
+
+from pytmt import tmt_reporters
+
+
+def quantify(psms,
+             spectra,
+             multiplex: int = 10,
+             panel=None,
+             precision: int = 10,
+             qvalue: float = 1.0,
+             parsimony: str = 'all',
+             contam=None,
+             nnls: bool = False,
+             silac: bool = False,
+             qc: bool = False,
+             min_purity: float = None,
+             isolation_width: float = 0.7,
+             profile: str = 'gaussian',
+             threads: int = 1,
+             workers: int = 1,
+             memory_limit: float = None,
+             queue: str = None,
+             lease_timeout: float = 300.,
+             out: str = None,
+             logger: logging.Logger = None,
+             ) -> tuple:
+    """
+    Quantifies the tmt reporters of the psms and collapses them into proteins, without going through files
+
+    Usage:
+        psm_df, protein_df = pytmt.quantify(psm_df, {0: 'frac_0.mzML', 1: mzml}, multiplex=16, contam=matrix)
+
+    :param psms:            pd.DataFrame or Arrow table of psms with file_idx, scan, percolator q-value,
+                            protein id and sequence columns, or path to a percolator target psms file
+    :param spectra:         path to the folder containing the mzml files, or dictionary of file_idx and
+                            the path of its mzml file or its (parsed or unparsed) get_spec.Mzml
+    :param multiplex:       TMT-plex (0, 2, 6, 10, 11, 16, 18)
+    :param panel:           tmt_reporters.ReporterPanel or path of a reporter panel file, instead of the multiplex
+    :param precision:       mass precision in ppm
+    :param qvalue:          quantify psms with q value at or below this threshold
+    :param parsimony:       rule to collapse peptides into the protein level: 'all', 'unique', or 'canonical'
+    :param contam:          contaminant matrix as a pd.DataFrame or reporters x reporters array, or path or file
+                            handle of a contaminant matrix csv file; None for no correction
+    :param nnls:            uses non-negative least square for correction
+    :param silac:           mark peptides with SILAC reporter ions
+    :param qc:              also return the reporter qc metrics
+    :param min_purity:      skip psms with precursor isolation purity below this threshold and return the purity
+    :param isolation_width: width of the precursor isolation window (m/z) for the purity
+    :param profile:         how to treat profile spectra: 'gaussian', 'parabolic', 'area', or 'pymzml'
+    :param threads:         number of threads used to decode the spectra of each mzml file
+    :param workers:         number of fractions quantified in parallel worker processes
+    :param memory_limit:    memory limit of the worker processes in GB, None for no limit
+    :param queue:           distribute the fractions through a work queue in this shared directory
+    :param lease_timeout:   seconds without a heartbeat from a queue worker after which its fraction is retried
+    :param out:             also write tmt_out.txt and tmt_protein_out.txt to this directory; None to not write
+    :param logger:          logger
+    :return:                tuple of (psm dataframe, protein dataframe)
+    """
+
+    import pandas as pd
+    from pytmt import scheduler
+    from pytmt.main import read_psms, get_mzml_paths, quantify_fraction, quantify_psms, get_reporter_range, \
+        summarize
+
+    logger = logger if logger else logging.getLogger(__name__)
+
+    assert min_purity is None or 0. <= min_purity <= 1., f'[error] min_purity {min_purity} not in range [0.0, 1.0]'
+
+    # Get the reporter channels and their integration windows
+    reporters = tmt_reporters.ReporterPanel.load(panel if panel is not None else multiplex,
+                                                 precision=precision,
+                                                 logger=logger,
+                                                 )
+
+    # Read the psms from a file, or take them from a data frame or Arrow table
+    log_path = None
+    if isinstance(psms, (str, os.PathLike)):
+        id_df = read_psms(psms, logger=logger)
+
+        # 2022-03-28 pytmt will now attempt to read the percolator.log.txt file for fraction (file_idx) mzML assignment
+        log_path = os.path.join(os.path.dirname(psms), 'percolator.log.txt')
+    elif hasattr(psms, 'to_pandas'):
+        id_df = psms.to_pandas()
+    else:
+        id_df = pd.DataFrame(psms)
+
+    assert 'file_idx' in id_df.columns, '[error] psms have no file_idx column'
+
+    # Get all the file indices in the psms
+    file_indices = list(set(id_df['file_idx']))
+
+    # Get the mzml file or parsed spectra of each fraction
+    if isinstance(spectra, dict):
+        missing = [idx for idx in file_indices if idx not in spectra]
+        assert not missing, f'[error] no spectra given for file_idx {missing}'
+        mzml_paths = {idx: spectra[idx] for idx in file_indices}
+    else:
+        assert os.path.isdir(spectra), '[error] mzml directory path not valid'
+        mzml_paths = get_mzml_paths(file_indices=file_indices,
+                                    mzml_dir=spectra,
+                                    log_path=log_path,
+                                    logger=logger,
+                                    )
+
+    fraction_outputs = {}
+    jobs = []
+    for idx in file_indices:
+
+        # Make a subset dataframe with the current file index (fraction) being considered
+        fraction_id_df = id_df[id_df['file_idx'] == idx]
+
+        # Spectra opened by the caller are quantified here
+        if not isinstance(mzml_paths[idx], (str, os.PathLike)):
+            fraction_mzml = mzml_paths[idx]
+
+            if not fraction_mzml.mslvl_idx:
+                fraction_mzml.parse_mzml_ms2(mz_range=get_reporter_range(reporters, precision),
+                                             threads=threads,
+                                             ms1=min_purity is not None,
+                                             profile=profile,
+                                             )
+
+            assert min_purity is None or fraction_mzml.ms1index is not None, \
+                f'[error] spectra of file_idx {idx} were parsed without the ms1 index needed for purity'
+
+            fraction_outputs[idx] = quantify_psms(idx=idx,
+                                                  fraction_mzml=fraction_mzml,
+                                                  fraction_id_df=fraction_id_df,
+                                                  reporters=reporters,
+                                                  precision=precision,
+                                                  qvalue=qvalue,
+                                                  parsimony=parsimony,
+                                                  qc=qc,
+                                                  min_purity=min_purity,
+                                                  isolation_width=isolation_width,
+                                                  )
+            continue
+
+        jobs.append(scheduler.FractionJob(idx=idx,
+                                          mzml_path=os.path.abspath(mzml_paths[idx]),
+                                          n_psms=len(fraction_id_df),
+                                          kwargs=dict(idx=idx,
+                                                      mzml_path=os.path.abspath(mzml_paths[idx]),
+                                                      fraction_id_df=fraction_id_df,
+                                                      reporters=reporters,
+                                                      precision=precision,
+                                                      qvalue=qvalue,
+                                                      parsimony=parsimony,
+                                                      threads=threads,
+                                                      progress=workers <= 1 and queue is None,
+                                                      qc=qc,
+                                                      min_purity=min_purity,
+                                                      isolation_width=isolation_width,
+                                                      profile=profile,
+                                                      ),
+                                          ))
+
+    # 2026-10-19 fractions are run largest first over worker processes within the memory limit,
+    # or by pytmt worker processes on any node sharing the queue directory
+    if jobs and queue is not None:
+        from pytmt import workqueue
+
+        fraction_outputs.update(workqueue.run_queue(func=quantify_fraction,
+                                                    jobs=jobs,
+                                                    queue_dir=queue,
+                                                    lease_timeout=lease_timeout,
+                                                    logger=logger,
+                                                    ))
+
+    elif jobs:
+        fraction_outputs.update(scheduler.run_fractions(func=quantify_fraction,
+                                                        jobs=jobs,
+                                                        workers=workers,
+                                                        memory_limit=memory_limit * 1024
+                                                        if memory_limit is not None else None,
+                                                        logger=logger,
+                                                        ))
+
+    output_list = [row for idx in file_indices for row in fraction_outputs[idx]]
+
+    final_df, filtered_protein_df = summarize(id_df=id_df,
+                                              output_list=output_list,
+                                              reporters=reporters,
+                                              contam=contam,
+                                              nnls=nnls,
+                                              silac=silac,
+                                              parsimony=parsimony,
+                                              qc=qc,
+                                              purity=min_purity is not None,
+                                              )
+
+    if out is not None:
+        os.makedirs(out, exist_ok=True)
+
+        # Save the peptide file
+        final_df.to_csv(os.path.join(out, 'tmt_out.txt'), sep='\t')
+
+        # Save the protein file
+        filtered_protein_df.to_csv(os.path.join(out, 'tmt_protein_out.txt'), sep='\t')
+
+    return final_df, filtered_protein_df
@@ -4,25 +4,68 @@
 """ Perform matrix correction using a NNLS """
 
 import io
+import re
+import typing
 import pandas as pd
 import numpy as np
-import scipy.optimize
+
+
+def _channel_label(label) -> str:
+    """ Channel name of a contaminant matrix label such as tru_127N or obs_127N """
+    return re.sub('^(tru|obs)_', '', str(label).strip())
+
+
+def align_contam(contam: pd.DataFrame,
+                 channels: list,
+                 ) -> pd.DataFrame:
+    """
+    Reorder the rows (observed) and columns (true) of a labelled contaminant matrix to the reporter channels,
+    since the correction applies the matrix by position. A matrix without channel labels is taken to be
+    in the order of the channels already.
+
+    :param contam:      contaminant matrix, labelled as tru_<channel> columns and obs_<channel> rows
+    :param channels:    channel name of each reporter column, in order
+    :return:            contaminant matrix with rows and columns in the order of the channels
+    """
+
+    labels = list(contam.index) + list(contam.columns)
+    if not all(isinstance(label, str) for label in labels):
+        return contam
+
+    rows = {_channel_label(label): label for label in contam.index}
+    columns = {_channel_label(label): label for label in contam.columns}
+
+    assert set(rows) == set(channels) and set(columns) == set(channels), \
+        f'[error] contaminant matrix channels {list(columns)} do not match the reporter channels {list(channels)}'
+
+    return contam.loc[[rows[channel] for channel in channels], [columns[channel] for channel in channels]]
 
 
 def correct_matrix(output_df: pd.DataFrame,
-                   contam: io.TextIOWrapper,
+                   contam: typing.Union[io.TextIOWrapper, str, pd.DataFrame, np.ndarray],
                    nnls: bool = True,
+                   channels: list = None,
                    ) -> pd.DataFrame:
     """
 
     :param output_df:   TMT intensity output matrix, with file_idx,  scan, m..., spectrum_int as columns
-    :param contam:      File handle to the contaminant matrix
+    :param contam:      File handle or path to the contaminant matrix, or the contaminant matrix itself
+                        as a dataframe or an array
     :param nnls:        Bool: uses non-negative least square for correction
+    :param channels:    channel name of each reporter column, to align a labelled contaminant matrix with;
+                        None to apply the matrix as it is
     :return:            pd.Dataframe with Corrected TMT intensity output dataframe with additional columns
 
     """
     # Read the contaminant matrix
-    contam = pd.read_csv(contam, index_col=0)
+    if isinstance(contam, np.ndarray):
+        contam = pd.DataFrame(contam)
+    elif not isinstance(contam, pd.DataFrame):
+        contam = pd.read_csv(contam, index_col=0)
+
+    # 2026-10-19 reporter panels may list their channels in any order; the matrix is applied by position
+    if channels is not None:
+        contam = align_contam(contam, channels)
 
     # Normalize the contaminant matrix prior to correction
     contam_star = contam / contam.sum(axis=0)
@@ -32,6 +75,9 @@ def correct_matrix(output_df: pd.DataFrame,
                                                                    'the same dimension as number of tags'
 
     if nnls:
+        # scipy is only imported when needed as it is slow to load
+        import scipy.optimize
+
         # Rowwise, use scipy NNLS to correct the output_df (TMT intensities) with the normalized contam matrix
         array_list = [scipy.optimize.nnls(contam_star, output_df.iloc[i, 2:len(output_df.columns) - 1])[0]
                   for i in range(0, len(output_df.index))]
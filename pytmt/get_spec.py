@@ -2,8 +2,289 @@
 
 """ Reads in mzml file using pymzml and get list of ms2 scans """
 
+import collections
+import concurrent.futures
 import logging
-import pymzml as mz
+import numpy as np
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pymzml as mz
+
+# Number of spectra allowed in flight per decoding thread before the tokenizer waits for results
+PIPELINE_DEPTH = 8
+
+# Mass difference between isotopes (13C - 12C)
+ISOTOPE_SPACING = 1.003355
+
+# Profile points kept on each side of the m/z range, so that the peaks at its edges are fitted as in the full
+# spectrum: the apex just outside the range, its neighbour, and one of the two leading points skipped when centroiding
+CENTROID_MARGIN = 3
+
+
+def reduce_peaks(peaks,
+                 mz_range: tuple = None,
+                 ) -> tuple:
+    """
+    Reduce a decoded spectrum to the peaks within an m/z range, keeping the total ion current and noise level.
+    Centroided spectra are noise-thresholded, so the weakest peak of the full spectrum approximates the noise.
+
+    :param peaks: array of [mz, I] peaks
+    :param mz_range: tuple of (lower, upper) m/z to keep, None keeps all peaks
+    :return: tuple of (array of [mz, I] peaks within the range, total ion current, noise level of the full spectrum)
+    """
+
+    peaks = np.asarray(peaks, dtype=float).reshape(-1, 2)
+    tic = float(peaks[:, 1].sum())
+    positive = peaks[peaks[:, 1] > 0, 1]
+    noise = float(positive.min()) if len(positive) else None
+
+    if mz_range is not None:
+        lower, upper = mz_range
+        peaks = peaks[(peaks[:, 0] >= lower) & (peaks[:, 0] <= upper)]
+
+    return peaks, tic, noise
+
+
+def centroid_profile(mz_values: np.ndarray,
+                     intensities: np.ndarray,
+                     method: str = 'gaussian',
+                     ) -> np.ndarray:
+    """
+    Centroid a profile spectrum by fitting the apex of each local maximum and its two neighbours.
+    The gaussian fit follows pymzml, including skipping maxima with very uneven point spacing.
+
+    :param mz_values: array of m/z of the profile points
+    :param intensities: array of intensities of the profile points
+    :param method: 'gaussian' or 'parabolic' apex fit
+    :return: array of [mz, I] peaks
+    """
+
+    mz_values = np.asarray(mz_values, dtype=float)
+    intensities = np.asarray(intensities, dtype=float)
+
+    # Local maxima with non-zero neighbours; as in pymzml the first two points are not considered
+    pos = np.arange(2, len(intensities) - 1)
+    x1, x2, x3 = mz_values[pos - 1], mz_values[pos], mz_values[pos + 1]
+    y1, y2, y3 = intensities[pos - 1], intensities[pos], intensities[pos + 1]
+
+    is_peak = (0 < y1) & (y1 < y2) & (y2 > y3) & (y3 > 0)
+    is_peak &= ~((x2 - x1 > (x3 - x2) * 10) | ((x2 - x1) * 10 < x3 - x2))
+
+    x1, x2, x3, y1, y2, y3 = (v[is_peak] for v in (x1, x2, x3, y1, y2, y3))
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if method == 'gaussian':
+            y3 = np.where(y3 == y1, y3 + 0.01 * y1, y3)
+            double_log = np.log(y2 / y1) / np.log(y3 / y1)
+            mue = (double_log * (x1 * x1 - x3 * x3) - x1 * x1 + x2 * x2) / (2 * (x2 - x1) - 2 * double_log * (x3 - x1))
+            c_squared = (x2 * x2 - x1 * x1 - 2 * x2 * mue + 2 * x1 * mue) / (2 * np.log(y1 / y2))
+            apex = y1 * np.exp((x1 - mue) * (x1 - mue) / (2 * c_squared))
+
+        elif method == 'parabolic':
+            denominator = (x2 - x1) * (y2 - y3) - (x2 - x3) * (y2 - y1)
+            mue = x2 - 0.5 * ((x2 - x1) ** 2 * (y2 - y3) - (x2 - x3) ** 2 * (y2 - y1)) / denominator
+            curvature = ((y3 - y2) / (x3 - x2) - (y2 - y1) / (x2 - x1)) / (x3 - x1)
+            apex = y2 - curvature * (x2 - mue) ** 2
+
+        else:
+            raise ValueError(f'Unknown centroiding method {method}')
+
+    fitted = np.isfinite(mue) & np.isfinite(apex)
+
+    return np.stack((mue[fitted], apex[fitted]), axis=-1)
+
+
+def is_profile(spec: 'mz.spec.Spectrum') -> bool:
+    """
+    Check whether a spectrum is in profile mode
+
+    :param spec: pymzml spectrum
+    :return: True if the spectrum is annotated as a profile spectrum
+    """
+    return spec.element.find(".//*[@accession='MS:1000128']") is not None
+
+
+def _decode_spectrum(spec: 'mz.spec.Spectrum',
+                     mz_range: tuple = None,
+                     profile: str = 'gaussian',
+                     ) -> tuple:
+    """
+    Decode the binary arrays of one spectrum and reduce them to the m/z range.
+    Called from the decoding threads; base64, zlib and numpy do the heavy lifting here.
+
+    Profile spectra are cut to the m/z range first, then centroided with numpy ('gaussian' or 'parabolic'),
+    or centroided whole by pymzml ('pymzml'). With 'area', the profile points within the m/z range are kept as they
+    are for area integration. The total ion current of a profile spectrum is read from its TIC cvParam, or summed
+    over the profile points if it has none, and its noise level is the weakest centroided peak within the range.
+
+    :param spec: pymzml spectrum
+    :param mz_range: tuple of (lower, upper) m/z to keep
+    :param profile: how to treat profile spectra: 'gaussian', 'parabolic', 'area', or 'pymzml'
+    :return: tuple of (peaks, tic, noise, whether the peaks are profile points)
+    """
+
+    if profile == 'pymzml' or not is_profile(spec):
+        return (*reduce_peaks(spec.peaks("centroided"), mz_range), False)
+
+    raw = spec.peaks("raw")
+
+    try:
+        tic = spec.TIC
+    except (AttributeError, TypeError, ValueError):     # no TIC cvParam
+        tic = float(raw[:, 1].sum())
+
+    if mz_range is not None:
+        start = max(int(np.searchsorted(raw[:, 0], mz_range[0], side='left')) - CENTROID_MARGIN, 0)
+        end = int(np.searchsorted(raw[:, 0], mz_range[1], side='right')) + CENTROID_MARGIN
+        raw = raw[start:end]
+
+    centroided, _, noise = reduce_peaks(centroid_profile(raw[:, 0], raw[:, 1],
+                                                         method='parabolic' if profile == 'parabolic' else 'gaussian'),
+                                        mz_range)
+
+    if profile == 'area':
+        return reduce_peaks(raw, mz_range)[0], tic, noise, True
+
+    return centroided, tic, noise, False
+
+
+class Ms1Index(object):
+    """ Ms1Index class. """
+
+    def __init__(
+            self,
+            ms1data: dict,
+            rt_idx: dict = None,
+    ) -> None:
+        """
+        This class holds the ms1 peaks of a fraction as flat arrays sorted by scan and m/z,
+        so that the m/z windows of all psms of the fraction can be queried at once
+
+        :param ms1data: dictionary of scan number and array of [mz, I] peaks of the ms1 spectra
+        :param rt_idx: dictionary of scan number and retention time
+        """
+
+        scans = sorted(ms1data)
+        spectra = [ms1data[scan][np.argsort(ms1data[scan][:, 0], kind='stable')] for scan in scans]
+        lengths = np.array([len(spectrum) for spectrum in spectra], dtype=int)
+        peaks = np.concatenate(spectra) if spectra else np.empty((0, 2))
+
+        self.scans = np.array(scans, dtype=int)    # scan numbers of the ms1 spectra
+        self.rts = np.array([_rt_value(rt_idx.get(scan)) if rt_idx else np.nan
+                             for scan in scans], dtype=float)  # retention times of the ms1 spectra
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])    # start of each ms1 spectrum in the peak arrays
+        self.mz = peaks[:, 0]   # m/z of all ms1 peaks
+        self.intensity = peaks[:, 1]    # intensity of all ms1 peaks
+
+        # Searching on (spectrum position * stride + m/z) finds a window within one spectrum in a single search,
+        # and the cumulative intensity turns the window into a sum
+        self._stride = np.ceil(self.mz.max()) + 1 if len(self.mz) else 1.
+        self._key = np.repeat(np.arange(len(scans)), lengths) * self._stride + self.mz
+        self._cumsum = np.concatenate([[0], np.cumsum(self.intensity)])
+
+    def preceding(self,
+                  scans: np.ndarray,
+                  ) -> np.ndarray:
+        """
+        Find the nearest preceding ms1 spectrum of each scan
+
+        :param scans: array of scan numbers
+        :return: array of positions of the ms1 spectra, -1 if there is no preceding ms1 spectrum
+        """
+        return np.searchsorted(self.scans, np.asarray(scans), side='right') - 1
+
+    def window_intensity(self,
+                         positions: np.ndarray,
+                         lower: np.ndarray,
+                         upper: np.ndarray,
+                         ) -> np.ndarray:
+        """
+        Sum the intensity of the peaks within an m/z window of each ms1 spectrum
+
+        :param positions: array of positions of the ms1 spectra
+        :param lower: array of lower m/z bounds
+        :param upper: array of upper m/z bounds
+        :return: array of summed intensities, 0 where the position is -1
+        """
+
+        positions = np.asarray(positions)
+        start = np.searchsorted(self._key, positions * self._stride + np.asarray(lower), side='left')
+        end = np.searchsorted(self._key, positions * self._stride + np.asarray(upper), side='right')
+
+        return np.where(positions >= 0, self._cumsum[end] - self._cumsum[start], 0.)
+
+    def envelope_intensity(self,
+                           positions: np.ndarray,
+                           mz: np.ndarray,
+                           charge: np.ndarray,
+                           precision: int,
+                           isotopes: int = 4,
+                           mz_range: tuple = None,
+                           ) -> np.ndarray:
+        """
+        Sum the intensity of the isotope envelope of each precursor in its ms1 spectrum
+
+        :param positions: array of positions of the ms1 spectra
+        :param mz: array of precursor m/z
+        :param charge: array of precursor charges
+        :param precision: mass tolerance of each isotope peak (ppm)
+        :param isotopes: number of isotope peaks starting from the precursor m/z
+        :param mz_range: tuple of arrays of (lower, upper) m/z; only isotope peaks within are summed
+        :return: array of summed intensities
+        """
+
+        # Isotope peaks of each precursor, as a precursors x isotopes matrix
+        peaks = np.asarray(mz, dtype=float)[:, None] + \
+            np.arange(isotopes) * ISOTOPE_SPACING / np.asarray(charge, dtype=float)[:, None]
+        tolerance = peaks * (precision / 2) * 1e-6
+
+        intensities = self.window_intensity(positions=np.repeat(positions, isotopes),
+                                            lower=(peaks - tolerance).ravel(),
+                                            upper=(peaks + tolerance).ravel(),
+                                            ).reshape(peaks.shape)
+
+        if mz_range is not None:
+            lower, upper = mz_range
+            intensities[(peaks < np.asarray(lower)[:, None]) | (peaks > np.asarray(upper)[:, None])] = 0.
+
+        return intensities.sum(axis=1)
+
+    def purity(self,
+               scans: np.ndarray,
+               mz: np.ndarray,
+               charge: np.ndarray,
+               isolation_width: float,
+               precision: int,
+               ) -> np.ndarray:
+        """
+        Get the precursor isolation purity of each ms2 scan: the fraction of intensity in the isolation window
+        of the nearest preceding ms1 spectrum that belongs to the isotope envelope of the precursor
+
+        :param scans: array of ms2 scan numbers
+        :param mz: array of precursor m/z
+        :param charge: array of precursor charges
+        :param isolation_width: width of the isolation window (m/z)
+        :param precision: mass tolerance of each isotope peak (ppm)
+        :return: array of purity between 0 and 1, nan if there is no ms1 signal in the isolation window
+        """
+
+        positions = self.preceding(scans)
+        mz = np.asarray(mz, dtype=float)
+        lower, upper = mz - isolation_width / 2, mz + isolation_width / 2
+
+        total = self.window_intensity(positions, lower, upper)
+        envelope = self.envelope_intensity(positions, mz, charge, precision, mz_range=(lower, upper))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total > 0, envelope / total, np.nan)
+
+
+def _rt_value(rt) -> float:
+    """ Get the value of a pymzml scan time, which may come with its unit """
+    if rt is None:
+        return np.nan
+    return float(rt[0]) if isinstance(rt, tuple) else float(rt)
 
 
 class Mzml(object):
@@ -23,20 +304,44 @@ class Mzml(object):
         """
 
         self.path = path    # path of the mzml file to be loaded, e.g., "~/Desktop/example.mzml"
+        self.ms1data = {}    # dictionary of ms1 spectra, only kept until the ms1 index is built
         self.ms2data = {}    # dictionary of ms2 spectra
         self.ms3data = {}    # dictionary of ms3 spectra
         self.prec_idx = {}  # dictionary of precursor scan id
+        self.prec_mz_idx = {}   # dictionary of precursor m/z
+        self.prec_z_idx = {}    # dictionary of precursor charge
         self.rt_idx = {}    # dictionary of retention times
         self.mslvl_idx = {} # dictionary of ms levels
+        self.tic_idx = {}   # dictionary of total ion current of the ms2 and ms3 spectra
+        self.noise_idx = {} # dictionary of noise level of the ms2 and ms3 spectra
+        self.profile_idx = {}   # dictionary of whether the stored ms2 and ms3 peaks are profile points
+        self.ms1index = None    # index of the ms1 peaks for precursor purity
         self.precision = precision  # integer determines precision of reading as well as mass tolerance of peak integration (ppm)
         self.logger = logger if logger else logging.getLogger(__name__)     # logger
 
-    def parse_mzml_ms2(self) -> None:
+    def parse_mzml_ms2(self,
+                       mz_range: tuple = None,
+                       threads: int = 1,
+                       ms1: bool = False,
+                       profile: str = 'gaussian',
+                       ) -> None:
         """
         Read the mzml file and create data dictionary for all ms2 peaks
+
+        The spectrum elements are tokenized in the calling thread while the binary arrays are decoded
+        and reduced in a pool of threads. Scan order is preserved.
+
+        :param mz_range: tuple of (lower, upper) m/z; if given only the peaks in range are kept (e.g., reporter region)
+        :param threads: number of threads used to decode the binary arrays
+        :param ms1: also decode the ms1 spectra and build the ms1 index
+        :param profile: how to treat profile spectra: 'gaussian' or 'parabolic' centroiding with numpy,
+                        'area' to keep the profile points for area integration, or 'pymzml' centroiding
         :return:
         """
 
+        # pymzml is only imported once a file is actually parsed
+        import pymzml as mz
+
         run = mz.run.Reader(self.path)
 
         # 2023-10-04: added ms3 support
@@ -44,23 +349,122 @@ class Mzml(object):
                              2: self.precision * 1e-6,
                              3: self.precision * 1e-6}
 
+        n = -1
+        if threads > 1:
+            # pymzml parses its obo translator lazily on first lookup, which is not thread-safe
+            _ = run.OT['32-bit float']
 
-        for n, spec in enumerate(run):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                pending = collections.deque()
 
-            self.mslvl_idx[n + 1] = spec.ms_level
-            self.rt_idx[n + 1] = spec.scan_time
+                for n, spec in enumerate(run):
+                    if self._index_spectrum(n + 1, spec, ms1):
+                        pending.append((n + 1, spec.ms_level,
+                                        executor.submit(_decode_spectrum, spec,
+                                                        *self._decode_options(spec, mz_range, profile))))
 
-            if spec.ms_level == 2:
-                self.ms2data[n + 1] = spec.peaks("centroided")
-                self.prec_idx[n + 1] = spec.selected_precursors[0].get('precursor id')
+                    # Collect finished spectra in scan order so the queue does not grow without bound
+                    while len(pending) > threads * PIPELINE_DEPTH:
+                        scan, ms_level, future = pending.popleft()
+                        self._store_spectrum(scan, ms_level, *future.result())
 
-            elif spec.ms_level == 3:
-                self.ms3data[n + 1] = spec.peaks("centroided")
-                self.prec_idx[n + 1] = spec.selected_precursors[0].get('precursor id')
+                while pending:
+                    scan, ms_level, future = pending.popleft()
+                    self._store_spectrum(scan, ms_level, *future.result())
 
-            else:
-                continue
+        else:
+            for n, spec in enumerate(run):
+                if self._index_spectrum(n + 1, spec, ms1):
+                    self._store_spectrum(n + 1, spec.ms_level,
+                                         *_decode_spectrum(spec, *self._decode_options(spec, mz_range, profile)))
 
         self.logger.info(f'Parsed {n + 1} spectra from file {self.path}')
 
+        if ms1:
+            self.ms1index = Ms1Index(self.ms1data, self.rt_idx)
+            self.ms1data = {}
+            self.logger.info(f'Indexed {len(self.ms1index.mz)} peaks from {len(self.ms1index.scans)} ms1 spectra')
+
+        return None
+
+    def _index_spectrum(self,
+                        scan: int,
+                        spec: 'mz.spec.Spectrum',
+                        ms1: bool = False,
+                        ) -> bool:
+        """
+        Record the ms level, retention time, and precursor of a spectrum
+
+        :param scan: scan number
+        :param spec: pymzml spectrum
+        :param ms1: whether ms1 spectra are decoded
+        :return: True if the spectrum is ms2 or ms3 (or ms1 if requested) and its peaks should be decoded
+        """
+
+        self.mslvl_idx[scan] = spec.ms_level
+        self.rt_idx[scan] = spec.scan_time
+
+        if spec.ms_level in [2, 3]:
+            precursor = spec.selected_precursors[0]
+            self.prec_idx[scan] = precursor.get('precursor id')
+            self.prec_mz_idx[scan] = precursor.get('mz')
+            self.prec_z_idx[scan] = precursor.get('charge')
+            return True
+
+        return ms1 and spec.ms_level == 1
+
+    @staticmethod
+    def _decode_options(spec: 'mz.spec.Spectrum',
+                        mz_range: tuple,
+                        profile: str,
+                        ) -> tuple:
+        """
+        Get the m/z range and profile treatment to decode a spectrum with.
+        Ms1 spectra are kept whole and always centroided for the ms1 index.
+
+        :param spec: pymzml spectrum
+        :param mz_range: tuple of (lower, upper) m/z to keep of the ms2 and ms3 spectra
+        :param profile: how to treat profile ms2 and ms3 spectra
+        :return: tuple of (m/z range, profile)
+        """
+
+        if spec.ms_level == 1:
+            return None, 'gaussian' if profile == 'area' else profile
+
+        return mz_range, profile
+
+    def _store_spectrum(self,
+                        scan: int,
+                        ms_level: int,
+                        peaks: np.ndarray,
+                        tic: float,
+                        noise: float,
+                        profile: bool = False,
+                        ) -> None:
+        """
+        Store the decoded peaks of an ms1, ms2 or ms3 spectrum
+
+        :param scan: scan number
+        :param ms_level: ms level of the spectrum
+        :param peaks: array of [mz, I] peaks
+        :param tic: total ion current of the spectrum
+        :param noise: noise level of the spectrum
+        :param profile: whether the peaks are profile points
+        :return:
+        """
+
+        if ms_level == 1:
+            self.ms1data[scan] = peaks
+            return None
+
+        elif ms_level == 2:
+            self.ms2data[scan] = peaks
+
+        elif ms_level == 3:
+            self.ms3data[scan] = peaks
+
+        self.tic_idx[scan] = tic
+        self.noise_idx[scan] = noise
+        self.profile_idx[scan] = profile
+
         return None
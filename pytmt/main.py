@@ -4,80 +4,41 @@
 
 import os.path
 import sys
+import logging
 import re
-import pandas as pd
-import tqdm
 import argparse
+from typing import TYPE_CHECKING
 
 from pytmt import __version__
-from pytmt.get_spec import Mzml
-from pytmt import tmt_reporters
-from pytmt import quantify_spec
-from pytmt import correct_matrix
 
 from pytmt.logger import get_logger
-from pytmt.protein_group import get_canonical_parsimony_groups
 
-def quant(args: argparse.Namespace) -> None:
-    """
-     reads in Percolator tab-delimited results (PSMS) \\
-     and filter each row by protein-uniqueness and by Percolator q value \\
-     then it opens the corresponding mzML file of the fraction and finds the scan \\
-     and returns the intensity of each TMT reporter within specified \\
-     mass tolerance. Currently supports only Percolator, and MS2-level quantification.
-
-    Tested on:
-        standalone comet 2017.01rev4 > crux 3.1 percolator
-        crux 3.1 tide > crux 3.1 percolator
-
-    To-do features:
-        ms3 or multi-notch (shifting scan numbers)
-        read in mzID files rather than percolator
-        normalization and isotope purity adjustment
-        filtering based on ms1
-
-    Known issues:
-        uses only directory index to match mzml files because of percolator
-
-    Note:
-        currently the sum of intensities is returned if multiple peaks are within the tolerance of reporter
-
-    Usage:
-        pytmt tests/data/mzml tests/data/percolator/percolator.target.psms.txt -o out
+# 2026-10-19 pandas, numpy, pymzml and scipy are imported in the stages that use them,
+# so that --version, --help and argument errors return without loading them
+if TYPE_CHECKING:
+    import pandas as pd
+    from pytmt.get_spec import Mzml
 
-    Example values for arguments:
-        mzml = 'tests/data/mzml'
-        id = 'tests/data/percolator'
-        precision = 10
-        qvalue = 0.1
 
-    :param args:    arguments from argparse
-    :return:        Exit OK
+def read_psms(id_path: str,
+              logger: logging.Logger = None,
+              ) -> 'pd.DataFrame':
     """
+    Reads in a Crux Percolator or standalone Percolator psms file
 
-    # ---- Get the logger ----
-    logger = get_logger(__name__, args.out)
-    logger.info(args)
-    logger.info(__version__)
-
-    # Get the reporter masses
-    reporters = tmt_reporters.get_reporters(args.multiplex)
-
-    # Define the PPM of integration
-    precision = args.precision
-
-    assert os.path.isdir(args.mzml), '[error] mzml directory path not valid'
-    assert os.path.isfile(args.id.name), '[error] percolator file path not valid'
+    :param id_path: path of the percolator target psms file
+    :param logger:  logger
+    :return:        pd.DataFrame of psms with file_idx, scan, and protein id columns
+    """
 
-    # List all files in the percolator directory ending with target.psms.txt.
-        # id_files = [f for f in os.listdir(id_loc) if f.endswith('target.psms.txt')]
-        # assert len(id_files) == 1, 'Check percolator output directory has 1 *.target.psms.txt'
+    import pandas as pd
 
+    logger = logger if logger else logging.getLogger(__name__)
 
     # Read the Percolator psms file.
     is_standalone = False
     try:
-        id_df = pd.read_csv(filepath_or_buffer=args.id,  # os.path.join(id_loc, id_files[0]),
+        id_df = pd.read_csv(filepath_or_buffer=id_path,  # os.path.join(id_loc, id_files[0]),
                             sep='\t')
 
     except pd.errors.EmptyDataError:
@@ -102,7 +63,7 @@ def quant(args: argparse.Namespace) -> None:
 
         # The standalone percolator output has different number of columns per row because the proteins are separated by tabs
         # Read the first half of the table without the protein IDs
-        with open(args.id.name, 'r') as f:
+        with open(id_path, 'r') as f:
             f_ln = f.readlines()
 
         id_df = pd.DataFrame([ln.split('\t')[0:5] for ln in f_ln[1:]])
@@ -136,14 +97,28 @@ def quant(args: argparse.Namespace) -> None:
         sorted_index = sorted(set(id_df['file_name']))
         id_df['file_idx'] = id_df['file_name'].apply(sorted_index.index)
 
-    # Get all the file indices in the Percolator results file.
-    file_indices = list(set(id_df['file_idx']))
+    return id_df
+
 
-    # 2022-03-28 pytmt will now attempt to read the percolator.log.txt file for fraction (file_idx) mzML assignment
-    log_path = os.path.join(os.path.dirname(args.id.name), 'percolator.log.txt')
+def get_mzml_paths(file_indices: list,
+                   mzml_dir: str,
+                   log_path: str = None,
+                   logger: logging.Logger = None,
+                   ) -> dict:
+    """
+    Assigns an mzML file in the mzML directory to each file index (fraction) of the psms
+
+    :param file_indices:    file indices of the psms
+    :param mzml_dir:        directory of the mzML files
+    :param log_path:        path of the percolator.log.txt file, if any
+    :param logger:          logger
+    :return:                dictionary of file index and mzML path
+    """
+
+    logger = logger if logger else logging.getLogger(__name__)
 
     # If the log file exists, use it to read the assignment
-    if os.path.exists(log_path):
+    if log_path is not None and os.path.exists(log_path):
         logger.warning(f'Percolator log file exists at {log_path} and will be used for index assignment.')
 
         with open(log_path, 'r') as f:
@@ -165,7 +140,7 @@ def quant(args: argparse.Namespace) -> None:
         # Check that the number of mzMLs in the mzML folder is the same as the maximum of the ID file's file_idx column.
         # Note this will throw an error if not every fraction results in at least some ID, but we will ignore for now.
 
-        mzml_filelist = [f for f in os.listdir(args.mzml) if re.match('^.*.mzML', f)]
+        mzml_filelist = [f for f in os.listdir(mzml_dir) if re.match('^.*.mzML', f)]
         # Sort the mzML files by names
         # Note this may create a problem if the OS Percolator runs on has natural sorting (xxxx_2 before xxxx_10)
         # But we will ignore for now
@@ -183,119 +158,308 @@ def quant(args: argparse.Namespace) -> None:
     # Print mzml files to log
     logger.info(f'mzml file orders: {mzml_files}')
 
-    # For each file index (fraction), open the mzML file, and create a subset Percolator ID dataframe
+    mzml_paths = {}
     for idx in file_indices:
 
         # 2022-03-28 try to open either mzML or mzML.gz
-        if os.path.exists(os.path.join(args.mzml, mzml_files[idx] + '.mzML')):
-            mzml_path = os.path.join(args.mzml, mzml_files[idx] + '.mzML')
-        elif os.path.exists(os.path.join(args.mzml, mzml_files[idx] + '.mzML.gz')):
-            mzml_path = os.path.join(args.mzml, mzml_files[idx] + '.mzML.gz')
+        if os.path.exists(os.path.join(mzml_dir, mzml_files[idx] + '.mzML')):
+            mzml_paths[idx] = os.path.join(mzml_dir, mzml_files[idx] + '.mzML')
+        elif os.path.exists(os.path.join(mzml_dir, mzml_files[idx] + '.mzML.gz')):
+            mzml_paths[idx] = os.path.join(mzml_dir, mzml_files[idx] + '.mzML.gz')
         else:
-            raise FileNotFoundError(f'Could not find mzML file for index {idx} at {args.mzml}')
+            raise FileNotFoundError(f'Could not find mzML file for index {idx} at {mzml_dir}')
+
+    return mzml_paths
 
-        # Logging mzML
-        logger.info(f'Reading mzml file: {os.path.basename(mzml_path)} ({idx + 1} of {len(file_indices)})')
 
-        # Make a subset dataframe with the current file index (fraction) being considered
-        fraction_id_df = id_df[id_df['file_idx'] == idx]
+def get_reporter_range(reporters: list,
+                       precision: int,
+                       ) -> tuple:
+    """
+    Get the m/z region covering the integration windows of all reporters
 
-        # Arrange the PSM rows by scan number
-        fraction_id_df = fraction_id_df.sort_values(by='scan').reset_index(drop=True)
+    :param reporters:   reporter panel or list of reporters to be quantified
+    :param precision:   mass precision in ppm
+    :return:            tuple of (lower, upper) m/z
+    """
+    return (min(reporters) * (1 - (precision / 2) * 1e-6),
+            max(reporters) * (1 + (precision / 2) * 1e-6))
+
+
+def quantify_fraction(idx: int,
+                      mzml_path: str,
+                      fraction_id_df: 'pd.DataFrame',
+                      reporters: list,
+                      precision: int,
+                      qvalue: float,
+                      parsimony: str,
+                      threads: int = 1,
+                      progress: bool = True,
+                      qc: bool = False,
+                      min_purity: float = None,
+                      isolation_width: float = 0.7,
+                      profile: str = 'gaussian',
+                      ) -> list:
+    """
+    Opens the mzML file of one fraction and returns the reporter intensities of each qualifying PSM
+
+    :param idx:             file index of the fraction
+    :param mzml_path:       path of the mzML file of the fraction
+    :param fraction_id_df:  PSMs of the fraction
+    :param reporters:       reporter panel or list of reporters to be quantified
+    :param precision:       mass precision in ppm
+    :param qvalue:          q value threshold
+    :param parsimony:       parsimony rule; only unique peptides are quantified if 'unique'
+    :param threads:         number of threads used to decode the spectra
+    :param progress:        show a progress bar
+    :param qc:              also return the reporter qc metrics
+    :param min_purity:      skip PSMs with precursor isolation purity below this threshold and return the purity
+    :param isolation_width: width of the precursor isolation window (m/z) for the purity
+    :param profile:         how to treat profile spectra: 'gaussian', 'parabolic', 'area', or 'pymzml'
+    :return:                list of [file_idx, scan, reporter intensities..., spectrum_int, (qc metrics...), (purity)]
+    """
 
-        # Open the mzML file
-        fraction_mzml = Mzml(path=mzml_path,
-                             precision=precision,
-                             logger=logger,
-                             )
-        fraction_mzml.parse_mzml_ms2()
-        if fraction_mzml.ms3data != {}:
-            logger.info(f'Found {len(fraction_mzml.ms3data)} MS3 spectra in {os.path.basename(mzml_path)}')
+    from pytmt.get_spec import Mzml
+
+    logger = logging.getLogger(__name__)
+
+    # Logging mzML
+    logger.info(f'Reading mzml file: {os.path.basename(mzml_path)} (index {idx})')
+
+    # Open the mzML file; only the reporter region of each spectrum is kept after decoding
+    fraction_mzml = Mzml(path=mzml_path,
+                         precision=precision,
+                         logger=logger,
+                         )
+    fraction_mzml.parse_mzml_ms2(mz_range=get_reporter_range(reporters, precision),
+                                 threads=threads,
+                                 ms1=min_purity is not None,
+                                 profile=profile,
+                                 )
+
+    return quantify_psms(idx=idx,
+                         fraction_mzml=fraction_mzml,
+                         fraction_id_df=fraction_id_df,
+                         reporters=reporters,
+                         precision=precision,
+                         qvalue=qvalue,
+                         parsimony=parsimony,
+                         progress=progress,
+                         qc=qc,
+                         min_purity=min_purity,
+                         isolation_width=isolation_width,
+                         )
+
+
+def quantify_psms(idx: int,
+                  fraction_mzml: 'Mzml',
+                  fraction_id_df: 'pd.DataFrame',
+                  reporters: list,
+                  precision: int,
+                  qvalue: float,
+                  parsimony: str,
+                  progress: bool = True,
+                  qc: bool = False,
+                  min_purity: float = None,
+                  isolation_width: float = 0.7,
+                  ) -> list:
+    """
+    Returns the reporter intensities of each qualifying PSM of one fraction from its parsed mzML file
+
+    :param idx:             file index of the fraction
+    :param fraction_mzml:   parsed Mzml of the fraction
+    :param fraction_id_df:  PSMs of the fraction
+    :param reporters:       reporter panel or list of reporters to be quantified
+    :param precision:       mass precision in ppm
+    :param qvalue:          q value threshold
+    :param parsimony:       parsimony rule; only unique peptides are quantified if 'unique'
+    :param progress:        show a progress bar
+    :param qc:              also return the reporter qc metrics
+    :param min_purity:      skip PSMs with precursor isolation purity below this threshold and return the purity
+    :param isolation_width: width of the precursor isolation window (m/z) for the purity
+    :return:                list of [file_idx, scan, reporter intensities..., spectrum_int, (qc metrics...), (purity)]
+    """
 
-        # Loop through each qualifying row in sub_df_filtered
-        for i in tqdm.trange(len(fraction_id_df)):
+    import numpy as np
+    import tqdm
+    from pytmt import quantify_spec
 
-            # Get current scan number
-            scan = fraction_id_df.loc[i, 'scan']
+    logger = logging.getLogger(__name__)
 
-            # If q-value filter is on, skip any row that fails the filter.
-            if fraction_id_df.loc[i, 'percolator q-value'] > args.qvalue:
-                continue
+    if fraction_mzml.ms3data != {}:
+        logger.info(f'Found {len(fraction_mzml.ms3data)} MS3 spectra in {os.path.basename(fraction_mzml.path)}')
 
-            # If the parsimony setting is set to unique, skip any row that fails the filter.
-            if args.parsimony == 'unique' and len(fraction_id_df.loc[i, 'protein id'].split(',')) > 1:
+    # Arrange the PSM rows by scan number
+    fraction_id_df = fraction_id_df.sort_values(by='scan').reset_index(drop=True)
+
+    # Get the precursor isolation purity of all PSMs of the fraction at once
+    if min_purity is not None:
+        scans = fraction_id_df['scan'].values
+        if 'charge' in fraction_id_df.columns:
+            charges = fraction_id_df['charge'].values
+        else:
+            charges = [fraction_mzml.prec_z_idx.get(scan) or 1 for scan in scans]
+
+        purity = fraction_mzml.ms1index.purity(scans=scans,
+                                               mz=[fraction_mzml.prec_mz_idx.get(scan, np.nan) for scan in scans],
+                                               charge=charges,
+                                               isolation_width=isolation_width,
+                                               precision=precision,
+                                               )
+
+    output_list = []
+
+    # Loop through each qualifying row in sub_df_filtered
+    for i in tqdm.trange(len(fraction_id_df), disable=not progress):
+
+        # Get current scan number
+        scan = fraction_id_df.loc[i, 'scan']
+
+        # If q-value filter is on, skip any row that fails the filter.
+        if fraction_id_df.loc[i, 'percolator q-value'] > qvalue:
+            continue
+
+        # If the parsimony setting is set to unique, skip any row that fails the filter.
+        if parsimony == 'unique' and len(fraction_id_df.loc[i, 'protein id'].split(',')) > 1:
+            continue
+
+        # If the purity filter is on, skip any row that fails the filter. Rows without ms1 signal are kept.
+        if min_purity is not None and purity[i] < min_purity:
+            continue
+
+        # If this is a qualifying row, get the spectrum in the mzML file by scan number
+        # First check if the spectrum's ms3data is empty
+        if fraction_mzml.ms3data == {}:  # if ms3data is empty
+            try:
+                spectrum_scan = scan
+                spectrum = fraction_mzml.ms2data.get(scan)
+                # Tidy this up
+                if spectrum is None:
+                    logger.error(f'[error] spectrum index {scan} out of bound or is empty')
+                    raise KeyError
+
+            except KeyError:
+                logger.error('[error] spectrum index out of bound')
                 continue
 
-            # If this is a qualifying row, get the spectrum in the mzML file by scan number
-            # First check if the spectrum's ms3data is empty
-            if fraction_mzml.ms3data == {}:  # if ms3data is empty
-                try:
-                    spectrum = fraction_mzml.ms2data.get(scan)
-                    # Tidy this up
-                    if spectrum is None:
-                        logger.error(f'[error] spectrum index {scan} out of bound or is empty')
-                        raise KeyError
-
-                except KeyError:
-                    logger.error('[error] spectrum index out of bound')
-                    continue
-
-            else:  # if ms3data is not empty
-                try:
-                    # Find the spectrum in the ms3data dictionary that has precursor id equal the ms2 spectrum
-                    for key, value in fraction_mzml.prec_idx.items():
-                        if int(value) == scan:
-                            spectrum = fraction_mzml.ms3data.get(key)
-
-                    # Tidy this up
-                    if spectrum is None:
-                        logger.error(f'[error] spectrum index {scan} out of bound or is empty')
-                        raise KeyError
-
-                except KeyError:
-                    logger.error('[error] spectrum index out of bound')
-                    continue
-
-
-
-
-            # Get the intensity of each reporter
-            tmt_intensities = quantify_spec.quantify_reporters(idx=idx,
-                                                               scan=scan,
-                                                               spectrum=spectrum,
-                                                               precision=precision,
-                                                               reporters=reporters,
-                                                               digits=2,
-                                                               )
-
-            # Grow the results into an output list of lists (creating if does not exist)
+        else:  # if ms3data is not empty
             try:
-                output_list.append(tmt_intensities)
+                # Find the spectrum in the ms3data dictionary that has precursor id equal the ms2 spectrum
+                for key, value in fraction_mzml.prec_idx.items():
+                    if int(value) == scan:
+                        spectrum_scan = key
+                        spectrum = fraction_mzml.ms3data.get(key)
+
+                # Tidy this up
+                if spectrum is None:
+                    logger.error(f'[error] spectrum index {scan} out of bound or is empty')
+                    raise KeyError
+
+            except KeyError:
+                logger.error('[error] spectrum index out of bound')
+                continue
 
-            except NameError:
-                output_list = [tmt_intensities]
 
-    # Turn the output list into a data frame
+
+
+        # Get the intensity of each reporter
+        tmt_intensities = quantify_spec.quantify_reporters(idx=idx,
+                                                           scan=scan,
+                                                           spectrum=spectrum,
+                                                           precision=precision,
+                                                           reporters=reporters,
+                                                           digits=2,
+                                                           spectrum_int=fraction_mzml.tic_idx.get(spectrum_scan),
+                                                           noise=fraction_mzml.noise_idx.get(spectrum_scan),
+                                                           qc=qc,
+                                                           area=fraction_mzml.profile_idx.get(spectrum_scan, False),
+                                                           )
+
+        if min_purity is not None:
+            tmt_intensities.append(round(float(purity[i]), 4))
+
+        output_list.append(tmt_intensities)
+
+    return output_list
+
+
+def get_output_columns(reporters: list,
+                       qc: bool = False,
+                       purity: bool = False,
+                       ) -> tuple:
+    """
+    Get the column names of the reporter intensity rows returned by quantify_psms
+
+    :param reporters:   reporter panel or list of reporters to be quantified
+    :param qc:          the rows include the reporter qc metrics
+    :param purity:      the rows include the precursor purity
+    :return:            tuple of (file_idx, scan, reporter and spectrum_int columns, extra columns)
+    """
+
+    from pytmt import quantify_spec
+
     output_df_columns = ['file_idx', 'scan', ]
 
-    for reporter in reporters:
-        output_df_columns.append('m' + str(reporter))
+    # 2026-10-19 channels of a reporter panel are named after the panel; plain reporter lists after their m/z
+    output_df_columns += getattr(reporters, 'columns', None) or ['m' + str(reporter) for reporter in reporters]
 
     output_df_columns.append('spectrum_int')
-    output_df = pd.DataFrame(output_list, columns=output_df_columns)
 
-    # Correct for contamination
-    if args.contam is not None:
-        output_df = correct_matrix.correct_matrix(output_df=output_df,
-                                                  contam=args.contam,
-                                                  nnls=args.nnls,
-                                                  )
+    extra_columns = quantify_spec.QC_COLUMNS if qc else []
+    if purity:
+        extra_columns = extra_columns + ['purity']
+
+    return output_df_columns, extra_columns
+
+
+def summarize(id_df: 'pd.DataFrame',
+              output_list: list,
+              reporters: list,
+              contam=None,
+              nnls: bool = False,
+              silac: bool = False,
+              parsimony: str = 'all',
+              qc: bool = False,
+              purity: bool = False,
+              ) -> tuple:
+    """
+    Corrects the reporter intensities for contamination, merges them with the psms, and collapses them to proteins
+
+    :param id_df:       psms
+    :param output_list: reporter intensity rows of all fractions
+    :param reporters:   reporter panel or list of reporters to be quantified
+    :param contam:      file handle or path to the contaminant matrix, or the contaminant matrix as a dataframe or
+                        an array; None for no correction
+    :param nnls:        uses non-negative least square for correction
+    :param silac:       mark peptides with SILAC reporter ions
+    :param parsimony:   rule to collapse peptides into the protein level
+    :param qc:          the rows include the reporter qc metrics
+    :param purity:      the rows include the precursor purity
+    :return:            tuple of (psm dataframe, protein dataframe)
+    """
+
+    import pandas as pd
+
+    # Turn the output list into a data frame
+    output_df_columns, extra_columns = get_output_columns(reporters, qc=qc, purity=purity)
+    output_df = pd.DataFrame(output_list, columns=output_df_columns + extra_columns)
+
+    # Correct for contamination; the correction expects spectrum_int as the last column
+    if contam is not None:
+        from pytmt import correct_matrix
+
+        output_df = pd.concat([correct_matrix.correct_matrix(output_df=output_df[output_df_columns],
+                                                             contam=contam,
+                                                             nnls=nnls,
+                                                             channels=getattr(reporters, 'names', None),
+                                                             ),
+                               output_df[extra_columns]], axis=1)
 
     # Final output, merging the input and output tables
     final_df = pd.merge(id_df, output_df, how='left')
 
     # Label light and heavy peptides
-    if args.silac:
+    if silac:
         heavy_mods = ["R\\[10.01\\]", "R\\[239.17\\]", "K\\[8.01\\]", "K\\[237.18\\]", "K\\[466.34\\]"]
         heavy = "|".join(heavy_mods)
 
@@ -309,27 +473,26 @@ def quant(args: argparse.Namespace) -> None:
                                   else final_df['protein id'][i]
                                   for i in range(len(final_df.index))]
 
-    # Save the peptide file
-    final_df.to_csv(os.path.join(args.out, 'tmt_out.txt'), sep='\t')
-
     # Collapse to protein level
-    if args.contam is not None:
-        protein_column_list = ['protein id', ] + [f'm{reporter}_cor' for reporter in reporters]
+    if contam is not None:
+        protein_column_list = ['protein id', ] + [f'{column}_cor' for column in output_df_columns[2:-1]]
     else:
-        protein_column_list = ['protein id'] + [f'm{reporter}' for reporter in reporters]
+        protein_column_list = ['protein id'] + output_df_columns[2:-1]
 
     protein_df = final_df[protein_column_list]
 
     # Sum the reporter intensities for each protein
-    if args.parsimony == 'unique':
+    if parsimony == 'unique':
         filtered_protein_df = protein_df[protein_df['protein id'].str.count(',') == 0]
 
-    elif args.parsimony == 'all':
+    elif parsimony == 'all':
         filtered_protein_df = protein_df
 
-    elif args.parsimony == 'canonical':
+    elif parsimony == 'canonical':
+        from pytmt.protein_group import get_canonical_parsimony_groups
+
         filtered_protein_df = get_canonical_parsimony_groups(result_df = protein_df,
-                                                             contam=args.contam,
+                                                             contam=contam,
                                                              reporters=reporters,
                                                              )
 
@@ -339,8 +502,82 @@ def quant(args: argparse.Namespace) -> None:
     # Remove any rows that are all zeros
     filtered_protein_df = filtered_protein_df[filtered_protein_df.sum(axis=1) > 0]
 
-    # Save the protein file
-    filtered_protein_df.to_csv(os.path.join(args.out, 'tmt_protein_out.txt'), sep='\t')
+    return final_df, filtered_protein_df
+
+
+def quant(args: argparse.Namespace) -> None:
+    """
+     reads in Percolator tab-delimited results (PSMS) \\
+     and filter each row by protein-uniqueness and by Percolator q value \\
+     then it opens the corresponding mzML file of the fraction and finds the scan \\
+     and returns the intensity of each TMT reporter within specified \\
+     mass tolerance. Currently supports only Percolator, and MS2-level quantification.
+
+    Tested on:
+        standalone comet 2017.01rev4 > crux 3.1 percolator
+        crux 3.1 tide > crux 3.1 percolator
+
+    To-do features:
+        ms3 or multi-notch (shifting scan numbers)
+        read in mzID files rather than percolator
+        normalization and isotope purity adjustment
+
+    Known issues:
+        uses only directory index to match mzml files because of percolator
+
+    Note:
+        currently the sum of intensities is returned if multiple peaks are within the tolerance of reporter
+
+    Usage:
+        pytmt tests/data/mzml tests/data/percolator/percolator.target.psms.txt -o out
+
+    Example values for arguments:
+        mzml = 'tests/data/mzml'
+        id = 'tests/data/percolator'
+        precision = 10
+        qvalue = 0.1
+
+    :param args:    arguments from argparse
+    :return:        Exit OK
+    """
+
+    from pytmt.api import quantify
+
+    # ---- Get the logger ----
+    logger = get_logger(__name__, args.out)
+    logger.info(args)
+    logger.info(__version__)
+
+    assert os.path.isdir(args.mzml), '[error] mzml directory path not valid'
+    assert os.path.isfile(args.id.name), '[error] percolator file path not valid'
+
+    # List all files in the percolator directory ending with target.psms.txt.
+        # id_files = [f for f in os.listdir(id_loc) if f.endswith('target.psms.txt')]
+        # assert len(id_files) == 1, 'Check percolator output directory has 1 *.target.psms.txt'
+
+    # 2026-10-19 the quantification runs through the library interface, which also writes the output files
+    quantify(psms=args.id.name,
+             spectra=args.mzml,
+             multiplex=args.multiplex,
+             panel=args.panel,
+             precision=args.precision,
+             qvalue=args.qvalue,
+             parsimony=args.parsimony,
+             contam=args.contam,
+             nnls=args.nnls,
+             silac=args.silac,
+             qc=args.qc,
+             min_purity=args.min_purity,
+             isolation_width=args.isolation_width,
+             profile=args.profile,
+             threads=args.threads,
+             workers=args.workers,
+             memory_limit=args.memory_limit,
+             queue=args.queue,
+             lease_timeout=args.lease_timeout,
+             out=args.out,
+             logger=logger,
+             )
 
     logger.info("Run completed successfully.")
 
@@ -372,6 +609,22 @@ class CheckQValue(argparse.Action):
         setattr(namespace, self.dest, values)
 
 
+class CheckPurity(argparse.Action):
+    """ Class to check that the minimum purity is between 0 and 1. """
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values < 0.0 or values > 1.0:
+            raise argparse.ArgumentError(self, "%r for min_purity not in range [0.0, 1.0]" % (values,))
+        setattr(namespace, self.dest, values)
+
+
+class CheckWorkers(argparse.Action):
+    """ Class to check that the number of workers is at least 1. """
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values < 1:
+            raise argparse.ArgumentError(self, "%r for workers not at least 1" % (values,))
+        setattr(namespace, self.dest, values)
+
+
 def main() -> None:
     """
     Entry point
@@ -379,6 +632,12 @@ def main() -> None:
     :return:
     """
 
+    # 2026-10-19 pytmt worker <queue dir> runs a worker of a distributed work queue
+    if sys.argv[1:2] == ['worker']:
+        from pytmt import workqueue
+        workqueue.main(sys.argv[2:])
+        return None
+
     parser = argparse.ArgumentParser(description='pytmt returns ms2 tmt quantification values'
                                                  'from Percolator output and perform contamination'
                                                  'correction',
@@ -421,6 +680,11 @@ def main() -> None:
                         type=int,
                         default=10)
 
+    parser.add_argument('--panel',
+                        help='reporter panel file with one channel per line as name,m/z; '
+                             'replaces the built-in panel of --multiplex, and names the output columns m<name>',
+                        )
+
     parser.add_argument('-p', '--precision',
                         help='ms2 spectrum mass shift tolerance in ppm [default: 10]',
                         type=int,
@@ -428,6 +692,36 @@ def main() -> None:
                         metavar='[0, 100]',
                         default=10)
 
+    parser.add_argument('-t', '--threads',
+                        help='number of threads used to decode the spectra of each mzml file [default: 1]',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('-w', '--workers',
+                        help='number of fractions quantified in parallel worker processes [default: 1]',
+                        type=int,
+                        default=1,
+                        action=CheckWorkers,
+                        )
+
+    parser.add_argument('--memory-limit',
+                        help='start a new fraction only while the projected memory of all workers stays '
+                             'below this limit in GB [default: no limit]',
+                        type=float,
+                        )
+
+    parser.add_argument('--queue',
+                        help='distribute the fractions through a work queue in this directory, shared with '
+                             'the nodes running "pytmt worker <queue dir>" [default: run locally]',
+                        )
+
+    parser.add_argument('--lease-timeout',
+                        help='seconds without a heartbeat from a queue worker after which its fraction is retried '
+                             '[default: 300]',
+                        type=float,
+                        default=300.,
+                        )
+
     parser.add_argument('-o', '--out', help='name of the output directory [default: tmt_out]',
                         default='tmt_out')
 
@@ -442,6 +736,35 @@ def main() -> None:
                         help='uses non-negative least square for contamination correction',
                         )
 
+    parser.add_argument('--profile',
+                        help='how to quantify profile-mode spectra: centroid with a "gaussian" or "parabolic" '
+                             'apex fit, integrate the profile "area" within each reporter window, or use '
+                             'the slower "pymzml" centroiding',
+                        choices=['gaussian', 'parabolic', 'area', 'pymzml'],
+                        default='gaussian',
+                        )
+
+    parser.add_argument('--qc',
+                        action='store_true',
+                        help='report reporter qc metrics for each psm (summed reporter S/N, missing channels, '
+                             'fraction of spectrum intensity in reporters, and reporter m/z error in ppm)',
+                        )
+
+    parser.add_argument('--min-purity',
+                        help='quantify psms with precursor isolation purity in the preceding ms1 at or above '
+                             'this threshold, and report the purity [default: no filter]',
+                        metavar='[0, 1]',
+                        type=float,
+                        action=CheckPurity,
+                        )
+
+    parser.add_argument('--isolation-window',
+                        help='width of the precursor isolation window in m/z for the purity [default: 0.7]',
+                        dest='isolation_width',
+                        type=float,
+                        default=0.7,
+                        )
+
     parser.add_argument('-S', '--silac',
                         help='mark peptides with SILAC reporter ions',
                         action='store_true',
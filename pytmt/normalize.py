@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+""" Normalizes the protein tmt intensities of multiple plexes (sample loading and internal reference scaling) """
+
+import argparse
+import os
+import sys
+from typing import TYPE_CHECKING
+
+from pytmt import __version__
+from pytmt.logger import get_logger
+
+# numpy and pandas are imported where they are used, so that --version and --help return without loading them
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+
+class PlexMatrix(object):
+    """ PlexMatrix class. """
+
+    def __init__(
+            self,
+            intensities: 'np.ndarray',
+            proteins: 'pd.Index',
+            plexes: list,
+            channels: list,
+    ) -> None:
+        """
+        This class holds the protein intensities of multiple plexes as one array aligned by protein
+
+        :param intensities: array of proteins x columns, nan where a protein is not quantified in a plex
+        :param proteins: index of protein ids
+        :param plexes: plex name of each column
+        :param channels: channel name of each column
+        """
+
+        import numpy as np
+
+        self.intensities = intensities  # proteins x columns of all plexes
+        self.proteins = proteins    # protein ids of the rows
+        self.plexes = np.array(plexes)  # plex name of each column
+        self.channels = np.array(channels)  # channel name of each column
+
+    @classmethod
+    def from_tables(cls,
+                    tables: list,
+                    names: list,
+                    ) -> 'PlexMatrix':
+        """
+        Align the protein tables of multiple plexes by protein id
+
+        :param tables: list of protein dataframes indexed by protein id, with one column per channel
+        :param names: list of plex names
+        :return: PlexMatrix
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        assert len(tables) == len(names), '[error] one name is needed for each plex'
+        assert len(set(names)) == len(names), '[error] plex names are not unique'
+
+        proteins = pd.Index(sorted(set().union(*[table.index for table in tables])), name='protein id')
+
+        n_columns = sum(len(table.columns) for table in tables)
+        intensities = np.full((len(proteins), n_columns), np.nan)
+        plexes, channels = [], []
+
+        # Place each table into its columns at the rows of its proteins
+        start = 0
+        for table, name in zip(tables, names):
+            rows = proteins.get_indexer(table.index)
+            intensities[rows, start:start + len(table.columns)] = table.to_numpy(dtype=float)
+            plexes += [name] * len(table.columns)
+            channels += list(table.columns)
+            start += len(table.columns)
+
+        return cls(intensities=intensities, proteins=proteins, plexes=plexes, channels=channels)
+
+    def _plex_masks(self) -> list:
+        """ Boolean masks of the columns of each plex, in order of appearance """
+        return [self.plexes == plex for plex in dict.fromkeys(self.plexes)]
+
+    def loading_normalize(self,
+                          method: str = 'median',
+                          ) -> None:
+        """
+        Sample loading normalization: scale every channel so that its median (or total) intensity
+        equals the mean median (or total) over all channels of all plexes.
+        Channels without positive intensities, e.g., unused channels, are left as they are.
+
+        :param method: 'median' or 'sum'
+        :return:
+        """
+
+        import numpy as np
+
+        # Zero intensities are treated as missing
+        positive = np.where(self.intensities > 0, self.intensities, np.nan)
+        quantified = ~np.isnan(positive).all(axis=0)
+
+        if method == 'median':
+            channel_totals = np.nanmedian(positive[:, quantified], axis=0)
+        elif method == 'sum':
+            channel_totals = np.nansum(positive[:, quantified], axis=0)
+        else:
+            raise ValueError(f'Unknown loading normalization method {method}')
+
+        factors = np.ones(len(self.channels))
+        factors[quantified] = channel_totals.mean() / channel_totals
+
+        self.intensities = self.intensities * factors
+
+        return None
+
+    def irs_normalize(self,
+                      bridge: list,
+                      ) -> None:
+        """
+        Internal reference scaling: scale each plex so that the reference (the mean of its bridge channels)
+        of every protein equals the geometric mean of that protein's references over all plexes.
+        Proteins not quantified in the bridge channels of every plex become nan.
+
+        :param bridge: names of the bridge channels, present in every plex
+        :return: number of proteins not quantified in the bridge channels of every plex
+        """
+
+        import numpy as np
+
+        plex_masks = self._plex_masks()
+        references = np.empty((len(self.proteins), len(plex_masks)))
+
+        for n, mask in enumerate(plex_masks):
+            bridge_mask = mask & np.isin(self.channels, bridge)
+            assert bridge_mask.any(), f'[error] bridge channels {bridge} not found in plex {self.plexes[mask][0]}'
+            references[:, n] = self.intensities[:, bridge_mask].mean(axis=1)
+
+        references = np.where(references > 0, references, np.nan)
+        geometric_mean = np.exp(np.log(references).mean(axis=1))
+
+        # Expand the per-plex factors of each protein to the columns of each plex
+        factors = geometric_mean[:, None] / references
+        column_plex = np.zeros(len(self.plexes), dtype=int)
+        for n, mask in enumerate(plex_masks):
+            column_plex[mask] = n
+
+        self.intensities = self.intensities * factors[:, column_plex]
+
+        return int(np.isnan(references).any(axis=1).sum())
+
+    def to_frame(self) -> 'pd.DataFrame':
+        """
+        Get the combined matrix as a dataframe with plex:channel columns
+
+        :return: pd.DataFrame indexed by protein id
+        """
+
+        import pandas as pd
+
+        return pd.DataFrame(self.intensities,
+                            index=self.proteins,
+                            columns=[f'{plex}:{channel}' for plex, channel in zip(self.plexes, self.channels)],
+                            )
+
+
+def read_protein_table(path: str) -> 'pd.DataFrame':
+    """
+    Read a pytmt protein output table
+
+    :param path: path of tmt_protein_out.txt, or of the pytmt output directory containing it
+    :return: pd.DataFrame indexed by protein id
+    """
+
+    import pandas as pd
+
+    if os.path.isdir(path):
+        path = os.path.join(path, 'tmt_protein_out.txt')
+
+    return pd.read_csv(path, sep='\t', index_col=0)
+
+
+def get_plex_name(path: str) -> str:
+    """
+    Name a plex after its pytmt output directory
+
+    :param path: path of tmt_protein_out.txt, or of the pytmt output directory containing it
+    :return: plex name
+    """
+
+    path = os.path.normpath(path)
+    if not os.path.isdir(path):
+        path = os.path.dirname(os.path.abspath(path))
+
+    return os.path.basename(path)
+
+
+def normalize(args: argparse.Namespace) -> None:
+    """
+    Reads the protein tables of multiple plexes, normalizes them together, and writes one combined matrix
+
+    Usage:
+        pytmt-normalize plex1_out plex2_out plex3_out -b m131.13818_cor -o normalized_out
+
+    :param args:    arguments from argparse
+    :return:        Exit OK
+    """
+
+    logger = get_logger(__name__, args.out)
+    logger.info(args)
+    logger.info(__version__)
+
+    names = args.names if args.names else [get_plex_name(path) for path in args.tables]
+
+    matrix = PlexMatrix.from_tables(tables=[read_protein_table(path) for path in args.tables],
+                                    names=names,
+                                    )
+    logger.info(f'Aligned {len(matrix.proteins)} proteins over {len(names)} plexes '
+                f'and {len(matrix.channels)} channels')
+
+    if args.loading != 'none':
+        matrix.loading_normalize(method=args.loading)
+
+    if args.bridge:
+        n_missing = matrix.irs_normalize(bridge=args.bridge)
+        logger.info(f'{n_missing} proteins are not quantified in the bridge channels of every plex')
+
+    matrix.to_frame().to_csv(os.path.join(args.out, 'tmt_protein_normalized.txt'), sep='\t')
+
+    logger.info("Run completed successfully.")
+
+    return None
+
+
+def main() -> None:
+    """
+    Entry point
+
+    :return:
+    """
+
+    parser = argparse.ArgumentParser(description='pytmt-normalize combines the protein tmt intensities '
+                                                 'of multiple plexes with sample loading normalization '
+                                                 'and internal reference scaling',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     epilog='For more information, see GitHub repository at '
+                                            'https://github.com/ed-lau/pytmt',
+                                     )
+
+    parser.add_argument('tables',
+                        help='<required> pytmt output directories or tmt_protein_out.txt files, one per plex',
+                        nargs='+',
+                        )
+
+    parser.add_argument('-N', '--names',
+                        help='plex names, in the same order as the tables [default: output directory names]',
+                        nargs='+',
+                        )
+
+    parser.add_argument('-l', '--loading',
+                        help='sample loading normalization of each channel',
+                        choices=['median', 'sum', 'none'],
+                        default='median',
+                        )
+
+    parser.add_argument('-b', '--bridge',
+                        help='bridge (reference) channel columns for internal reference scaling, '
+                             'e.g., m131.13818_cor. Leave blank to skip',
+                        nargs='+',
+                        )
+
+    parser.add_argument('-o', '--out', help='name of the output directory [default: tmt_normalized]',
+                        default='tmt_normalized')
+
+    parser.add_argument('-v', '--version', action='version',
+                        version='pyTMT {version}'.format(version=__version__))
+
+    parser.set_defaults(func=normalize)
+
+    # Print help message if no arguments are given
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    args.func(args)
+
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,94 @@
 # -*- coding: utf-8 -*-
 
 
-""" Given a spectrum, precision, and list of reporters, get reporter intensity values """
+""" Given a spectrum and a reporter panel (or precision and list of reporters), get reporter intensity values """
+
+import numpy as np
+
+from pytmt.tmt_reporters import ReporterPanel
+
+# Reporter qc metrics appended after spectrum_int when qc is requested
+QC_COLUMNS = ['reporter_sn', 'missing_channels', 'reporter_tic_fraction', 'reporter_ppm_error']
+
+
+def _window_sums(values: np.ndarray,
+                 first: np.ndarray,
+                 last: np.ndarray,
+                 ) -> np.ndarray:
+    """ Sum of values[first:last] of each window, 0 for empty windows """
+    # Windows past the last value are empty; their indices are clipped to stay within the padded values
+    bounds = np.minimum(np.stack([first, last], axis=1).ravel(), len(values))
+    sums = np.add.reduceat(np.append(values, 0.), bounds)[::2]
+    return np.where(last > first, sums, 0.)
 
 
 def quantify_reporters(idx: int,
                        scan: int,
                        spectrum: list,
                        precision: int,
-                       reporters: list,
-                       digits: int = 2) -> list:
+                       reporters,
+                       digits: int = 2,
+                       spectrum_int: float = None,
+                       noise: float = None,
+                       qc: bool = False,
+                       area: bool = False) -> list:
     """
 
     :param idx: file index, for reporting only
     :param scan: scan number of the spectrum, for reporting only
     :param spectrum: spectrum list of [mz/I]
-    :param precision: mass precision
-    :param reporters: list of reporters to be quantified
+    :param precision: mass precision, used when reporters is a list
+    :param reporters: tmt_reporters.ReporterPanel, or list of reporters to be quantified
     :param digits: number of significant digits to report
+    :param spectrum_int: total spectrum intensity, if recorded before the spectrum was reduced to the reporter region
+    :param noise: noise level of the spectrum, used for the reporter signal-to-noise
+    :param qc: also return the reporter qc metrics in QC_COLUMNS
+    :param area: the spectrum holds profile points; integrate the profile area within each reporter window
     :return: list of intensities
 
     """
 
-    tmt_intensities = [idx, scan]
+    if not isinstance(reporters, ReporterPanel):
+        reporters = ReporterPanel(reporters, precision=precision)
+    reporter_mz, lower, upper = reporters.arrays
 
-    for reporter in reporters:
-        upper = reporter + reporter * (precision / 2) * 1e-6
-        lower = reporter - reporter * (precision / 2) * 1e-6
+    peaks = np.asarray(spectrum, dtype=float).reshape(-1, 2)
+    mz_values, intensities = peaks[:, 0], peaks[:, 1]
 
-        try:
-            reporter_intensity = sum([I for mz_value, I in spectrum if upper > mz_value > lower])
-        except TypeError:
-            reporter_intensity = 0.0
+    if (np.diff(mz_values) < 0).any():
+        order = np.argsort(mz_values, kind='stable')
+        mz_values, intensities = mz_values[order], intensities[order]
 
-        tmt_intensities.append(round(reporter_intensity, digits))
+    # The peaks within the tolerance window of each reporter are those from first to last
+    first = np.searchsorted(mz_values, lower, side='right')
+    last = np.searchsorted(mz_values, upper, side='left')
+    peak_intensities = _window_sums(intensities, first, last)
+    reporter_intensities = peak_intensities
+
+    if area:
+        # Trapezoid area of the profile segments with both points within the window
+        segment_areas = np.diff(mz_values) * (intensities[:-1] + intensities[1:]) / 2
+        reporter_intensities = _window_sums(segment_areas, first, np.maximum(last - 1, first))
+
+    tmt_intensities = [idx, scan] + [round(float(i), digits) for i in reporter_intensities]
 
     # Write total spectrum intensity
-    spectrum_intensity = sum([I for mz_value, I in spectrum])
-    tmt_intensities.append(round(spectrum_intensity, digits))
+    if spectrum_int is None:
+        spectrum_int = intensities.sum()
+    tmt_intensities.append(round(float(spectrum_int), digits))
+
+    if qc:
+        reporter_sum = reporter_intensities.sum()
+
+        # Intensity-weighted mass error of the peaks matched to the reporters
+        mass_errors = (_window_sums(mz_values * intensities, first, last) - reporter_mz * peak_intensities) \
+            / reporter_mz * 1e6
+        mean_ppm_error = mass_errors.sum() / peak_intensities.sum() if peak_intensities.sum() > 0 else np.nan
+
+        tmt_intensities += [round(float(reporter_sum / noise), digits) if noise else np.nan,
+                            int((reporter_intensities == 0).sum()),
+                            round(float(reporter_sum / spectrum_int), digits + 2) if spectrum_int else np.nan,
+                            round(float(mean_ppm_error), digits),
+                            ]
 
     return tmt_intensities
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+""" Schedules the per-fraction quantification over worker processes within a memory limit """
+
+import concurrent.futures
+import gzip
+import logging
+import os
+import re
+import sys
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak memory will not be measured
+    resource = None
+
+# Default memory model (MB), refined by the measured peak memory of each finished fraction
+BASE_MB = 150.
+MB_PER_MZML_MB = 2.
+MB_PER_SPECTRUM = 0.02
+MB_PER_PSM = 0.002
+
+# Relative cost of decoding a spectrum and quantifying a psm, used to dispatch the largest fractions first
+SPECTRUM_COST = 1.
+PSM_COST = 0.2
+
+
+def get_mzml_size(path: str) -> float:
+    """
+    Get the uncompressed size of an mzML or mzML.gz file
+
+    :param path: path of the mzml file
+    :return: size in MB
+    """
+
+    if path.endswith('.gz'):
+        # The gzip trailer holds the uncompressed size modulo 2**32
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            size = int.from_bytes(f.read(4), 'little')
+        size = max(size, os.path.getsize(path))
+    else:
+        size = os.path.getsize(path)
+
+    return size / 1024 ** 2
+
+
+def get_spectrum_count(path: str) -> int:
+    """
+    Read the spectrum count from the spectrumList element at the head of an mzML or mzML.gz file
+
+    :param path: path of the mzml file
+    :return: number of spectra, or 0 if the count is not found
+    """
+
+    opener = gzip.open if path.endswith('.gz') else open
+
+    try:
+        with opener(path, 'rb') as f:
+            head = f.read(1024 ** 2)
+    except OSError:
+        return 0
+
+    match = re.search(rb'<spectrumList[^>]*count="([0-9]+)"', head)
+
+    return int(match.group(1)) if match else 0
+
+
+class FractionJob(object):
+    """ One fraction to be quantified, with its estimated cost and size """
+
+    def __init__(self,
+                 idx: int,
+                 mzml_path: str,
+                 n_psms: int,
+                 kwargs: dict,
+                 ) -> None:
+        """
+        :param idx: file index of the fraction
+        :param mzml_path: path of the mzml file of the fraction
+        :param n_psms: number of psms in the fraction
+        :param kwargs: keyword arguments of the fraction function
+        """
+
+        self.idx = idx
+        self.mzml_path = mzml_path
+        self.n_psms = n_psms
+        self.kwargs = kwargs
+        self.mzml_mb = get_mzml_size(mzml_path)
+        self.n_spectra = get_spectrum_count(mzml_path)
+
+    @property
+    def cost(self) -> float:
+        """ Relative cost of quantifying the fraction """
+        return self.n_spectra * SPECTRUM_COST + self.n_psms * PSM_COST + self.mzml_mb
+
+
+class MemoryModel(object):
+    """ Predicts the peak memory of a fraction and learns from measured peaks """
+
+    def __init__(self) -> None:
+        self.ratio = 1.     # measured over estimated peak memory of finished fractions
+        self.n_measured = 0
+
+    @staticmethod
+    def estimate(job: FractionJob) -> float:
+        """
+        Estimate the peak memory of a fraction from the default memory model
+
+        :param job: fraction job
+        :return: estimated memory in MB
+        """
+        return BASE_MB + MB_PER_MZML_MB * job.mzml_mb + MB_PER_SPECTRUM * job.n_spectra + MB_PER_PSM * job.n_psms
+
+    def predict(self, job: FractionJob) -> float:
+        """
+        Predict the peak memory of a fraction
+
+        :param job: fraction job
+        :return: predicted memory in MB
+        """
+        return self.estimate(job) * self.ratio
+
+    def update(self, job: FractionJob, peak_mb: float) -> None:
+        """
+        Update the model with the measured peak memory of a finished fraction
+
+        :param job: fraction job
+        :param peak_mb: measured peak memory in MB
+        :return:
+        """
+        ratio = peak_mb / self.estimate(job)
+
+        # The first measurement replaces the default model, later ones are averaged in
+        self.ratio = ratio if self.n_measured == 0 else (self.ratio + ratio) / 2
+        self.n_measured += 1
+
+        return None
+
+
+def get_peak_memory() -> float:
+    """
+    Get the peak resident memory of the current process
+
+    :return: peak memory in MB, or None if it cannot be measured
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def reset_peak_memory() -> None:
+    """
+    Reset the peak resident memory of the current process to its current value (Linux only).
+    A worker otherwise reports the peak memory of its parent or of the fractions it ran before.
+
+    :return:
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+    return None
+
+
+def _run_job(func, kwargs: dict) -> tuple:
+    """
+    Run a fraction in a worker process and measure its peak memory
+
+    :param func: fraction function
+    :param kwargs: keyword arguments of the fraction function
+    :return: tuple of (result, peak memory in MB)
+    """
+    reset_peak_memory()
+    result = func(**kwargs)
+    return result, get_peak_memory()
+
+
+def run_fractions(func,
+                  jobs: list,
+                  workers: int = 1,
+                  memory_limit: float = None,
+                  logger: logging.Logger = None,
+                  ) -> dict:
+    """
+    Run the fraction function over all fraction jobs, largest first, in worker processes.
+    A new fraction is started only while the predicted memory of the running fractions stays under the limit;
+    a fraction larger than the limit is run on its own.
+
+    :param func: fraction function, called with the keyword arguments of each job
+    :param jobs: list of FractionJob
+    :param workers: maximum number of worker processes
+    :param memory_limit: memory limit in MB, None for no limit
+    :param logger: logger
+    :return: dictionary of file index and the result of the fraction function
+    """
+
+    logger = logger if logger else logging.getLogger(__name__)
+    workers = max(1, workers)
+
+    pending = sorted(jobs, key=lambda job: job.cost, reverse=True)
+    results = {}
+
+    # Run in this process if there is nothing to schedule
+    if workers <= 1 and memory_limit is None:
+        for job in pending:
+            results[job.idx] = func(**job.kwargs)
+        return results
+
+    model = MemoryModel()
+    running = {}    # future of each running fraction job
+    died = set()    # fractions whose worker process died, retried on their own
+
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    try:
+        while pending or running:
+
+            # Admit the largest pending fractions that fit under the memory limit;
+            # a fraction whose worker died runs with no other fraction
+            for job in list(pending):
+                if len(running) >= workers or any(j.idx in died for j in running.values()):
+                    break
+
+                if job.idx in died and running:
+                    continue
+
+                projected = sum(model.predict(j) for j in running.values()) + model.predict(job)
+                if memory_limit is not None and running and projected > memory_limit:
+                    continue
+
+                if memory_limit is not None and projected > memory_limit:
+                    logger.warning(f'Fraction {job.idx} is predicted to use {model.predict(job):.0f} MB, '
+                                   f'above the memory limit of {memory_limit:.0f} MB; running it on its own.')
+
+                logger.info(f'Starting fraction {job.idx} ({job.mzml_mb:.0f} MB mzml, {job.n_spectra} spectra, '
+                            f'{job.n_psms} psms, predicted {model.predict(job):.0f} MB); '
+                            f'projected memory {projected:.0f} MB')
+
+                pending.remove(job)
+                running[pool.submit(_run_job, func, job.kwargs)] = job
+
+            # Wait for a fraction to finish
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in finished:
+                job = running.pop(future)
+
+                try:
+                    results[job.idx], peak_mb = future.result()
+
+                except concurrent.futures.process.BrokenProcessPool:
+                    # A worker process was killed, e.g., by the out-of-memory killer, which breaks the whole pool
+                    lost = [job] + list(running.values())
+
+                    if job.idx in died:
+                        raise RuntimeError(f'[error] the worker process of fraction {job.idx} died while it ran '
+                                           f'on its own (killed, possibly out of memory); '
+                                           f'try a machine with more memory') from None
+
+                    logger.warning(f'A worker process died (killed, possibly out of memory) while fractions '
+                                   f'{sorted(j.idx for j in lost)} were running; retrying each of them on its own')
+
+                    died.update(j.idx for j in lost)
+                    pending = sorted(pending + lost, key=lambda j: j.cost, reverse=True)
+                    running = {}
+                    pool.shutdown(wait=True)
+                    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+                    break
+
+                if peak_mb is not None:
+                    logger.info(f'Fraction {job.idx} finished with peak memory {peak_mb:.0f} MB '
+                                f'(predicted {model.predict(job):.0f} MB)')
+                    model.update(job, peak_mb)
+
+    finally:
+        if sys.version_info >= (3, 9):
+            pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            pool.shutdown(wait=False)
+
+    return results
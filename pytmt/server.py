@@ -0,0 +1,682 @@
+# -*- coding: utf-8 -*-
+
+""" Runs pytmt as a long-running local service with warm worker processes, contaminant matrices and spectra """
+
+import argparse
+import collections
+import concurrent.futures
+import getpass
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+from typing import TYPE_CHECKING
+
+from pytmt import __version__
+from pytmt import tmt_reporters
+from pytmt.logger import get_logger
+
+if TYPE_CHECKING:
+    from pytmt.get_spec import Mzml
+
+# Spectra are cached for the widest reporter region, so any plex and precision can reuse them
+CACHE_PRECISION = 100
+CACHE_RANGE = tmt_reporters.ReporterPanel(tmt_reporters.REPORTERS, precision=CACHE_PRECISION).range
+
+
+
+def get_runtime_dir() -> str:
+    """
+    Get the per-user directory of the server socket and token
+
+    :return: $XDG_RUNTIME_DIR, or a pytmt-<uid> directory in the temporary directory
+    """
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return runtime_dir
+
+    user = os.getuid() if hasattr(os, 'getuid') else getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), f'pytmt-{user}')
+
+
+def _make_private_dir(path: str) -> None:
+    """
+    Create a directory only the current user can use, and check that an existing one is
+
+    :param path: path of the directory
+    :return:
+    """
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    if hasattr(os, 'getuid'):
+        stat = os.stat(path)
+        assert stat.st_uid == os.getuid() and not stat.st_mode & 0o077, \
+            f'[error] {path} is not a private directory of the current user'
+
+    return None
+
+
+def get_token_path(port: int) -> str:
+    """ Path of the file holding the token that clients of the server on a localhost port must send """
+    return os.path.join(get_runtime_dir(), f'pytmt-{port}.token')
+
+
+DEFAULT_SOCKET = os.path.join(get_runtime_dir(), 'pytmt.sock')
+
+
+def get_default_contams() -> str:
+    """
+    Get the directory of the contaminant matrices shipped with pytmt
+
+    :return: path of pytmt/contams when installed, or of contams/ in the source tree
+    """
+
+    try:
+        from importlib.resources import files
+        installed = str(files('pytmt') / 'contams')
+    except ImportError:     # python < 3.9
+        installed = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'contams')
+
+    if os.path.isdir(installed):
+        return installed
+
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'contams')
+
+
+# Job parameters and their defaults, as in the pytmt command line
+JOB_DEFAULTS = {'multiplex': 10,
+                'panel': None,
+                'precision': 10,
+                'qvalue': 1.0,
+                'parsimony': 'all',
+                'contam': None,
+                'nnls': False,
+                'silac': False,
+                'qc': False,
+                'min_purity': None,
+                'isolation_width': 0.7,
+                'profile': 'gaussian',
+                'out': None,
+                'return_proteins': True,
+                }
+
+
+def _warm_worker() -> None:
+    """ Import the spectrum reading dependencies when a worker process starts """
+    import pymzml  # noqa: F401
+    import pytmt.get_spec  # noqa: F401
+
+
+def _parse_mzml(mzml_path: str,
+                mz_range: tuple = CACHE_RANGE,
+                threads: int = 1,
+                ms1: bool = False,
+                profile: str = 'gaussian',
+                ) -> 'Mzml':
+    """
+    Parse the reporter region of the spectra of an mzML file in a worker process
+
+    :param mzml_path: path of the mzML file
+    :param mz_range: m/z region of the ms2 and ms3 spectra to keep
+    :param threads: number of threads used to decode the spectra
+    :param ms1: also build the ms1 index
+    :param profile: how to treat profile spectra
+    :return: parsed Mzml
+    """
+
+    from pytmt.get_spec import Mzml
+
+    fraction_mzml = Mzml(path=mzml_path, precision=CACHE_PRECISION)
+    fraction_mzml.parse_mzml_ms2(mz_range=mz_range,
+                                 threads=threads,
+                                 ms1=ms1,
+                                 profile=profile,
+                                 )
+
+    return fraction_mzml
+
+
+def _to_json(value):
+    """ Convert numpy and pandas values for json """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'{type(value)} is not json serializable')
+
+
+class QuantService(object):
+    """ QuantService class. """
+
+    def __init__(
+            self,
+            workers: int = None,
+            threads: int = 1,
+            cache_size: int = 64,
+            contams: str = None,
+            logger: logging.Logger = None,
+    ) -> None:
+        """
+        This class keeps a pool of worker processes, the contaminant matrices, and the parsed spectra
+        of recently used mzML files, and runs quantification jobs against them
+
+        :param workers: number of worker processes that parse mzML files
+        :param threads: number of threads each worker uses to decode the spectra
+        :param cache_size: number of parsed mzML files kept in memory
+        :param contams: directory of the contaminant matrix csv files [default: the matrices shipped with pytmt]
+        :param logger: logger
+        """
+
+        import pandas as pd
+
+        self.threads = threads    # number of threads each worker uses to decode the spectra
+        self.cache_size = cache_size    # number of parsed mzML files kept in memory
+        self.cache = collections.OrderedDict()    # parsed Mzml by (path, mtime, size, ms1, profile), least recent first
+        self.lock = threading.Lock()    # guards the cache
+        self.logger = logger if logger else logging.getLogger(__name__)     # logger
+
+        # Contaminant matrices by file name without extension
+        contams = contams if contams is not None else get_default_contams()
+        assert os.path.isdir(contams), f'[error] contaminant matrix directory {contams} not found'
+
+        self.contams = {}
+        self.contam_files = {}  # contaminant matrices read from a path, by path, with their (mtime, size)
+        for filename in sorted(os.listdir(contams)):
+            if filename.endswith('.csv'):
+                self.contams[os.path.splitext(filename)[0]] = pd.read_csv(os.path.join(contams, filename),
+                                                                          index_col=0)
+
+        if self.contams:
+            self.logger.info(f'Loaded contaminant matrices from {contams}: {list(self.contams)}')
+        else:
+            self.logger.warning(f'No contaminant matrices found in {contams}; '
+                                f'jobs can only correct with a contaminant matrix given as a path')
+
+        # Start the workers now so the first job does not pay for it
+        workers = workers if workers else os.cpu_count()
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                           mp_context=multiprocessing.get_context('spawn'),
+                                                           initializer=_warm_worker,
+                                                           )
+        concurrent.futures.wait([self.pool.submit(_warm_worker) for _ in range(workers)])
+        self.logger.info(f'Started {workers} worker processes')
+
+    def close(self) -> None:
+        """ Shut down the worker processes """
+        self.pool.shutdown()
+
+    def get_contam(self, contam):
+        """
+        Get a contaminant matrix by name, or read it from a path
+
+        :param contam: name of a loaded contaminant matrix, or path to a contaminant matrix csv file
+        :return: pd.DataFrame of the contaminant matrix
+        """
+
+        import pandas as pd
+
+        if contam in self.contams:
+            return self.contams[contam]
+
+        assert os.path.isfile(contam), f'[error] contaminant matrix {contam} not found'
+
+        # A file edited while the server runs is read again, as are the spectra
+        path = os.path.realpath(contam)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            cached = self.contam_files.get(path)
+        if cached is None or cached[0] != version:
+            cached = (version, pd.read_csv(path, index_col=0))
+            with self.lock:
+                self.contam_files[path] = cached
+
+        return cached[1]
+
+    def _cache_key(self, mzml_path: str, mz_range: tuple, ms1: bool, profile: str) -> tuple:
+        """ Cache key of a parsed mzML file, which changes when the file does """
+        stat = os.stat(mzml_path)
+        return os.path.realpath(mzml_path), stat.st_mtime_ns, stat.st_size, mz_range, ms1, profile
+
+    def get_spectra(self,
+                    mzml_path: str,
+                    mz_range: tuple = CACHE_RANGE,
+                    ms1: bool = False,
+                    profile: str = 'gaussian',
+                    ) -> tuple:
+        """
+        Get the parsed spectra of an mzML file from the cache, or parse it in a worker process
+
+        :param mzml_path: path of the mzML file
+        :param mz_range: m/z region of the ms2 and ms3 spectra to keep
+        :param ms1: also build the ms1 index
+        :param profile: how to treat profile spectra
+        :return: tuple of (future of the parsed Mzml, whether it came from the cache)
+        """
+
+        key = self._cache_key(mzml_path, mz_range, ms1, profile)
+
+        with self.lock:
+            # Spectra parsed with the ms1 index also serve jobs without it
+            for candidate in [key, key[:4] + (True, profile)]:
+                if candidate in self.cache:
+                    # A file that failed to parse is tried again
+                    if self.cache[candidate].done() and self.cache[candidate].exception() is not None:
+                        del self.cache[candidate]
+                        continue
+                    self.cache.move_to_end(candidate)
+                    return self.cache[candidate], True
+
+            future = self.pool.submit(_parse_mzml, mzml_path, mz_range, self.threads, ms1, profile)
+            self.cache[key] = future
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return future, False
+
+    def run(self, job: dict):
+        """
+        Run a quantification job and yield its events: one per fraction as it finishes, then one when done
+
+        :param job: dictionary of job parameters: mzml (directory), id (percolator psms file) or psms
+                    (psm table as a dictionary of columns and data), and the parameters in JOB_DEFAULTS
+        :return: generator of event dictionaries
+        """
+
+        import pandas as pd
+        from pytmt.main import read_psms, get_mzml_paths, get_output_columns, quantify_psms, summarize
+
+        params = dict(JOB_DEFAULTS, **job)
+        assert params['min_purity'] is None or 0. <= params['min_purity'] <= 1., \
+            f'[error] min_purity {params["min_purity"]} not in range [0.0, 1.0]'
+
+        reporters = tmt_reporters.ReporterPanel.load(params['panel'] if params['panel'] is not None
+                                                     else params['multiplex'],
+                                                     precision=params['precision'],
+                                                     logger=self.logger,
+                                                     )
+
+        # Custom panels beyond the usual reporter region widen the cached region
+        mz_range = (min(CACHE_RANGE[0], reporters.range[0]), max(CACHE_RANGE[1], reporters.range[1]))
+
+        # Read the psms from a file, or take them from the job
+        if params.get('psms') is not None:
+            id_df = pd.DataFrame(**params['psms'])
+            log_path = None
+        else:
+            id_df = read_psms(params['id'], logger=self.logger)
+            log_path = os.path.join(os.path.dirname(params['id']), 'percolator.log.txt')
+
+        file_indices = list(set(id_df['file_idx']))
+        mzml_paths = get_mzml_paths(file_indices=file_indices,
+                                    mzml_dir=params['mzml'],
+                                    log_path=log_path,
+                                    logger=self.logger,
+                                    )
+
+        spectra = {idx: self.get_spectra(mzml_paths[idx],
+                                         mz_range=mz_range,
+                                         ms1=params['min_purity'] is not None,
+                                         profile=params['profile'],
+                                         ) for idx in file_indices}
+        futures = {future: idx for idx, (future, _) in spectra.items()}
+
+        output_df_columns, extra_columns = get_output_columns(reporters,
+                                                              qc=params['qc'],
+                                                              purity=params['min_purity'] is not None,
+                                                              )
+
+        # Quantify each fraction as soon as its spectra are ready
+        fraction_outputs = {}
+        for future in concurrent.futures.as_completed(futures):
+            idx = futures[future]
+            fraction_outputs[idx] = quantify_psms(idx=idx,
+                                                  fraction_mzml=future.result(),
+                                                  fraction_id_df=id_df[id_df['file_idx'] == idx],
+                                                  reporters=reporters,
+                                                  precision=params['precision'],
+                                                  qvalue=params['qvalue'],
+                                                  parsimony=params['parsimony'],
+                                                  progress=False,
+                                                  qc=params['qc'],
+                                                  min_purity=params['min_purity'],
+                                                  isolation_width=params['isolation_width'],
+                                                  )
+
+            yield {'event': 'fraction',
+                   'file_idx': idx,
+                   'mzml': mzml_paths[idx],
+                   'cached': spectra[idx][1],
+                   'columns': output_df_columns + extra_columns,
+                   'rows': fraction_outputs[idx],
+                   }
+
+        output_list = [row for idx in file_indices for row in fraction_outputs[idx]]
+
+        final_df, protein_df = summarize(id_df=id_df,
+                                         output_list=output_list,
+                                         reporters=reporters,
+                                         contam=self.get_contam(params['contam'])
+                                         if params['contam'] is not None else None,
+                                         nnls=params['nnls'],
+                                         silac=params['silac'],
+                                         parsimony=params['parsimony'],
+                                         qc=params['qc'],
+                                         purity=params['min_purity'] is not None,
+                                         )
+
+        if params['out'] is not None:
+            os.makedirs(params['out'], exist_ok=True)
+            final_df.to_csv(os.path.join(params['out'], 'tmt_out.txt'), sep='\t')
+            protein_df.to_csv(os.path.join(params['out'], 'tmt_protein_out.txt'), sep='\t')
+
+        done = {'event': 'done', 'psms': len(output_list), 'proteins': len(protein_df), 'out': params['out']}
+        if params['return_proteins']:
+            done['protein_table'] = protein_df.reset_index().to_dict(orient='split')
+
+        yield done
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """ Reads one json job per connection and streams back one json event per line """
+
+    def handle(self) -> None:
+        service = self.server.service
+
+        try:
+            job = json.loads(self.rfile.readline())
+
+            # Any local user can connect to a port, so tcp jobs must carry the token of the server
+            token = str(job.pop('token', ''))
+            if self.server.token is not None and not hmac.compare_digest(token, self.server.token):
+                raise PermissionError('job does not carry the token of the server')
+
+            service.logger.info(f'Received job: {job.get("id", "psm table")} with {job.get("mzml")}')
+
+            for event in service.run(job):
+                self.wfile.write((json.dumps(event, default=_to_json) + '\n').encode())
+                self.wfile.flush()
+
+        except Exception as e:
+            service.logger.error(f'[error] job failed: {e!r}')
+            self.wfile.write((json.dumps({'event': 'error', 'message': repr(e)}) + '\n').encode())
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    token = None    # access is limited by the permissions of the socket instead
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    token = None    # token that jobs must carry
+
+
+def _listen_unix(socket_path: str) -> _UnixServer:
+    """
+    Listen on a unix socket that only the current user can connect to. A socket left by a server that
+    has stopped is replaced; a socket that a running server answers on is left alone.
+
+    :param socket_path: path of the unix socket
+    :return: _UnixServer
+    """
+
+    if socket_path == DEFAULT_SOCKET:
+        _make_private_dir(os.path.dirname(socket_path))
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(socket_path)
+        except PermissionError:
+            raise RuntimeError(f'[error] {socket_path} belongs to another user')
+        else:
+            raise RuntimeError(f'[error] a server is already listening on {socket_path}')
+        finally:
+            probe.close()
+
+    umask = os.umask(0o177)
+    try:
+        server = _UnixServer(socket_path, _JobHandler)
+    finally:
+        os.umask(umask)
+
+    return server
+
+
+def _listen_tcp(port: int) -> _TCPServer:
+    """
+    Listen on a localhost port, and write the token that jobs must carry to a file only the current user can read
+
+    :param port: port on localhost
+    :return: _TCPServer
+    """
+
+    server = _TCPServer(('127.0.0.1', port), _JobHandler)
+    server.token = secrets.token_hex(16)
+
+    token_path = get_token_path(port)
+    _make_private_dir(os.path.dirname(token_path))
+    if os.path.exists(token_path):
+        os.remove(token_path)
+    with os.fdopen(os.open(token_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600), 'w') as f:
+        f.write(server.token)
+
+    return server
+
+
+def request(job: dict,
+            socket_path: str = DEFAULT_SOCKET,
+            port: int = None,
+            token: str = None,
+            ):
+    """
+    Send a job to a running pytmt server and yield its events
+
+    :param job: dictionary of job parameters, see QuantService.run
+    :param socket_path: path of the server's unix socket
+    :param port: port of the server on localhost, instead of the unix socket
+    :param token: token of the server on the port [default: read from the token file the server wrote]
+    :return: generator of event dictionaries
+    """
+
+    if port is not None:
+        if token is None:
+            with open(get_token_path(port), 'r') as f:
+                token = f.read().strip()
+        job = dict(job, token=token)
+        connection = socket.create_connection(('127.0.0.1', port))
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+
+    with connection, connection.makefile('rb') as events:
+        connection.sendall((json.dumps(job, default=_to_json) + '\n').encode())
+
+        for line in events:
+            event = json.loads(line)
+            yield event
+            if event['event'] in ['done', 'error']:
+                break
+
+
+def serve(args: argparse.Namespace) -> None:
+    """
+    Start the server and answer jobs until interrupted
+
+    :param args:    arguments from argparse
+    :return:        Exit OK
+    """
+
+    logger = get_logger(__name__, args.out)
+    logger.info(args)
+    logger.info(__version__)
+
+    # Take the socket or port first, so that a second server stops before starting its workers
+    if args.port is not None:
+        server = _listen_tcp(args.port)
+        logger.info(f'Listening on 127.0.0.1:{args.port}; clients send the token in {get_token_path(args.port)}')
+    else:
+        server = _listen_unix(args.socket)
+        logger.info(f'Listening on {args.socket}')
+
+    service = None
+
+    try:
+        service = QuantService(workers=args.workers,
+                               threads=args.threads,
+                               cache_size=args.cache_size,
+                               contams=args.contams,
+                               logger=logger,
+                               )
+        server.service = service
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if service is not None:
+            service.close()
+        if args.port is None and os.path.exists(args.socket):
+            os.remove(args.socket)
+        if args.port is not None and os.path.exists(get_token_path(args.port)):
+            os.remove(get_token_path(args.port))
+
+    return None
+
+
+def main() -> None:
+    """
+    Entry point of pytmt-server
+
+    :return:
+    """
+
+    parser = argparse.ArgumentParser(description='pytmt-server keeps worker processes, contaminant matrices '
+                                                 'and parsed spectra warm and answers quantification jobs '
+                                                 'from pytmt-client',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     )
+
+    parser.add_argument('-s', '--socket', help='path of the unix socket to listen on', default=DEFAULT_SOCKET)
+
+    parser.add_argument('--port', help='listen on this localhost port instead of the unix socket; any local user '
+                                       'can connect to a port, so jobs must carry the token that the server writes '
+                                       'to a file only the current user can read', type=int)
+
+    parser.add_argument('-w', '--workers', help='number of worker processes [default: number of cpus]', type=int)
+
+    parser.add_argument('-t', '--threads', help='number of threads used to decode the spectra of each mzml file',
+                        type=int, default=1)
+
+    parser.add_argument('--cache-size', help='number of parsed mzml files kept in memory', type=int, default=64)
+
+    parser.add_argument('--contams', help='directory of contaminant matrix csv files to load '
+                                          '[default: the matrices shipped with pytmt]')
+
+    parser.add_argument('-o', '--out', help='name of the log directory', default='tmt_server')
+
+    parser.add_argument('-v', '--version', action='version',
+                        version='pyTMT {version}'.format(version=__version__))
+
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    serve(args)
+
+    return None
+
+
+def client() -> None:
+    """
+    Entry point of pytmt-client
+
+    :return:
+    """
+
+    parser = argparse.ArgumentParser(description='pytmt-client sends a quantification job to a running pytmt-server',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     )
+
+    parser.add_argument('mzml', help='<required> path to folder containing mzml files')
+
+    parser.add_argument('id', help='<required> path to percolator target psms output file')
+
+    parser.add_argument('-P', '--parsimony', choices=['all', 'unique', 'canonical'], default='all')
+
+    parser.add_argument('-q', '--qvalue', type=float, default=1.0)
+
+    parser.add_argument('-m', '--multiplex', choices=[0, 2, 6, 10, 11, 16, 18], type=int, default=10)
+
+    parser.add_argument('--panel', help='reporter panel file, instead of the built-in panel of --multiplex')
+
+    parser.add_argument('-p', '--precision', type=int, default=10)
+
+    parser.add_argument('-c', '--contam', help='name of a contaminant matrix loaded by the server, '
+                                               'or path to a contaminant matrix csv file')
+
+    parser.add_argument('-n', '--nnls', action='store_true')
+
+    parser.add_argument('-S', '--silac', action='store_true')
+
+    parser.add_argument('--qc', action='store_true')
+
+    parser.add_argument('--min-purity', type=float)
+
+    parser.add_argument('--isolation-window', dest='isolation_width', type=float, default=0.7)
+
+    parser.add_argument('--profile', choices=['gaussian', 'parabolic', 'area', 'pymzml'], default='gaussian')
+
+    parser.add_argument('-o', '--out', help='name of the output directory [default: tmt_out]', default='tmt_out')
+
+    parser.add_argument('-s', '--socket', help='path of the server unix socket', default=DEFAULT_SOCKET)
+
+    parser.add_argument('--port', help='port of the server on localhost, instead of the unix socket', type=int)
+
+    parser.add_argument('--token', help='token of the server on --port [default: read from the token file of the port]')
+
+    args = parser.parse_args()
+
+    job = {key: value for key, value in vars(args).items() if key not in ['socket', 'port', 'token']}
+
+    # The server resolves paths from its own working directory
+    for key in ['mzml', 'id', 'out']:
+        job[key] = os.path.abspath(job[key])
+    if args.panel is not None:
+        job['panel'] = os.path.abspath(args.panel)
+    if args.contam is not None and os.path.isfile(args.contam):
+        job['contam'] = os.path.abspath(args.contam)
+    job['return_proteins'] = False
+
+    for event in request(job, socket_path=args.socket, port=args.port, token=args.token):
+        if event['event'] == 'fraction':
+            print(f'{os.path.basename(event["mzml"])}: {len(event["rows"])} psms quantified'
+                  f'{" (cached spectra)" if event["cached"] else ""}')
+
+        elif event['event'] == 'done':
+            print(f'Done: {event["psms"]} psms and {event["proteins"]} proteins written to {event["out"]}')
+
+        else:
+            print(f'[error] {event["message"]}', file=sys.stderr)
+            sys.exit(1)
+
+    return None
+
+
+if __name__ == '__main__':
+    main()
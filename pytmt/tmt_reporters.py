@@ -2,6 +2,9 @@
 
 """ Returns TMT reporter masses"""
 
+import logging
+import re
+
 REPORTERS = [126.127726,  # 126
              127.124761,  # 127N
              127.131081,  # 127C
@@ -22,6 +25,20 @@ REPORTERS = [126.127726,  # 126
              135.151600,  # 135N (Pro-18)
              ]
 
+CHANNELS = ['126', '127N', '127C', '128N', '128C', '129N', '129C', '130N', '130C', '131N',
+            '131C', '132N', '132C', '133N', '133C', '134N', '134C', '135N']
+
+# Reporters of each built-in plex, as indices into REPORTERS
+PLEXES = {18: range(0, 18),
+          16: range(0, 16),
+          11: range(0, 11),
+          10: range(0, 10),
+          6: [0, 2, 4, 5, 8, 9],
+          2: [0, 2],
+          0: range(0, 1),
+          }
+
+
 def get_reporters(plex):
     """
     Define the reporter ion m/z values. Support Thermo TMT 0, 2, 6, 10, 11, 16, or 18-plex for now.
@@ -30,27 +47,173 @@ def get_reporters(plex):
     :rtype: list
     """
 
-    #
+    return [REPORTERS[n] for n in PLEXES[plex]]
+
+
+class ReporterPanel(object):
+    """ ReporterPanel class. """
+
+    def __init__(
+            self,
+            mz: list,
+            names: list = None,
+            precision: float = 10,
+            name: str = None,
+            columns: list = None,
+    ) -> None:
+        """
+        This class holds the reporter channels of a panel sorted by m/z, with the integration window of each channel
+        compiled once for the mass tolerance. Iterating over a panel gives the reporter m/z values, so a panel can be
+        used wherever a list of reporters is expected.
+
+        :param mz: reporter m/z of each channel
+        :param names: name of each channel [default: the m/z]
+        :param precision: mass tolerance in ppm; the window of each channel is +/- half of it
+        :param name: name of the panel
+        :param columns: output column name of each channel [default: m and the channel name]
+        """
+
+        names = names if names is not None else [str(m) for m in mz]
+        columns = columns if columns is not None else [f'm{name}' for name in names]
+        assert len(names) == len(mz), '[error] one name is needed for each reporter channel'
+        assert len(columns) == len(mz), '[error] one column name is needed for each reporter channel'
+        assert len(set(names)) == len(names), '[error] reporter channel names are not unique'
+        assert len(set(mz)) == len(mz), '[error] reporter channel m/z values are not unique'
+
+        order = sorted(range(len(mz)), key=lambda n: mz[n])
+
+        self.mz = [float(mz[n]) for n in order]     # reporter m/z, sorted
+        self.names = [str(names[n]) for n in order]     # channel names, in m/z order
+        self.columns = [str(columns[n]) for n in order]     # output column names, in m/z order
+        self.precision = precision  # mass tolerance in ppm
+        self.name = name    # panel name
+        self.lower = [m - m * (precision / 2) * 1e-6 for m in self.mz]     # lower bound of each window
+        self.upper = [m + m * (precision / 2) * 1e-6 for m in self.mz]     # upper bound of each window
+        self._arrays = None     # numpy arrays of mz, lower and upper, built on first use
+
+    def __iter__(self):
+        return iter(self.mz)
+
+    def __len__(self) -> int:
+        return len(self.mz)
+
+    def __repr__(self) -> str:
+        return f'ReporterPanel({self.name or len(self.mz)}, {self.precision} ppm)'
+
+    @property
+    def arrays(self) -> tuple:
+        """ Reporter m/z, lower and upper bounds as numpy arrays """
+        if self._arrays is None:
+            import numpy as np
+            self._arrays = (np.array(self.mz), np.array(self.lower), np.array(self.upper))
+        return self._arrays
+
+    @property
+    def range(self) -> tuple:
+        """ m/z region covering the windows of all channels """
+        return self.lower[0], self.upper[-1]
+
+    def collisions(self) -> list:
+        """
+        Find the channels whose integration windows overlap; a peak within both is counted in both
+
+        :return: list of tuples of the names of overlapping channels
+        """
+        return [(self.names[n], self.names[n + 1]) for n in range(len(self.mz) - 1)
+                if self.upper[n] > self.lower[n + 1]]
+
+    def with_precision(self, precision: float) -> 'ReporterPanel':
+        """
+        Compile the same channels for another mass tolerance
+
+        :param precision: mass tolerance in ppm
+        :return: ReporterPanel
+        """
+        return ReporterPanel(mz=self.mz, names=self.names, precision=precision, name=self.name, columns=self.columns)
+
+    @classmethod
+    def builtin(cls,
+                plex: int,
+                precision: float = 10,
+                ) -> 'ReporterPanel':
+        """
+        Get a built-in Thermo TMT panel; its output columns keep the m/z names of the reporter lists
+
+        :param plex: tandem mass tag multiplex type (0, 2, 6, 10, 11, 16, or 18)
+        :param precision: mass tolerance in ppm
+        :return: ReporterPanel
+        """
+
+        assert plex in PLEXES, f'[error] no built-in panel for {plex}-plex'
+
+        return cls(mz=[REPORTERS[n] for n in PLEXES[plex]],
+                   names=[CHANNELS[n] for n in PLEXES[plex]],
+                   precision=precision,
+                   name=f'tmt{plex}',
+                   columns=['m' + str(REPORTERS[n]) for n in PLEXES[plex]],
+                   )
+
+    @classmethod
+    def from_file(cls,
+                  path: str,
+                  precision: float = 10,
+                  ) -> 'ReporterPanel':
+        """
+        Read a panel from a comma or tab separated file with one channel per line, as name and m/z,
+        or as m/z alone. A header line and lines starting with # are skipped. The output column of
+        each channel is m and its name.
+
+        :param path: path of the panel file
+        :param precision: mass tolerance in ppm
+        :return: ReporterPanel
+        """
+
+        names, mz = [], []
+
+        with open(path, 'r') as f:
+            for line in f:
+                fields = [field.strip() for field in re.split('[,\t]', line.strip())]
+                if fields == [''] or fields[0].startswith('#'):
+                    continue
+
+                try:
+                    value = float(fields[-1])
+                except ValueError:  # header
+                    continue
+
+                mz.append(value)
+                names.append(fields[0] if len(fields) > 1 else fields[-1])
 
-    if plex == 18:
-        reporters = [i for n, i in enumerate(REPORTERS)]
+        assert mz, f'[error] no reporter channels found in {path}'
 
-    elif plex == 16:
-        reporters = [i for n, i in enumerate(REPORTERS) if n in range(0, 16)]
+        return cls(mz=mz, names=names, precision=precision, name=path)
 
-    elif plex == 11:
-        reporters = [i for n, i in enumerate(REPORTERS) if n in range(0, 11)]
+    @classmethod
+    def load(cls,
+             panel,
+             precision: float = 10,
+             logger: logging.Logger = None,
+             ) -> 'ReporterPanel':
+        """
+        Get a panel for a mass tolerance from a built-in plex, a panel file, or a panel, and report overlapping windows
 
-    elif plex == 10:
-        reporters = [i for n, i in enumerate(REPORTERS) if n in range(0, 10)]
+        :param panel: tandem mass tag multiplex type, path of a panel file, or ReporterPanel
+        :param precision: mass tolerance in ppm
+        :param logger: logger
+        :return: ReporterPanel
+        """
 
-    elif plex == 6:
-        reporters = [i for n, i in enumerate(REPORTERS) if n in [0, 2, 4, 5, 8, 9]]
+        logger = logger if logger else logging.getLogger(__name__)
 
-    elif plex == 2:
-        reporters = [i for n, i in enumerate(REPORTERS) if n in [0, 2]]
+        if isinstance(panel, ReporterPanel):
+            panel = panel if panel.precision == precision else panel.with_precision(precision)
+        elif isinstance(panel, int):
+            panel = cls.builtin(panel, precision=precision)
+        else:
+            panel = cls.from_file(panel, precision=precision)
 
-    elif plex == 0:
-        reporters = [i for n, i in enumerate(REPORTERS) if n in range(0, 1)]
+        for channel, next_channel in panel.collisions():
+            logger.warning(f'Reporter windows of {channel} and {next_channel} overlap at {precision} ppm; '
+                           f'peaks within both are counted in both')
 
-    return reporters
\ No newline at end of file
+        return panel
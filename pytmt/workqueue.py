@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+
+""" Distributes the per-fraction quantification over worker processes on any node through a shared directory """
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from pytmt import __version__
+from pytmt.logger import get_logger
+
+# Seconds without a heartbeat after which the lease of a claimed fraction expires and the fraction is retried
+LEASE_TIMEOUT = 300.
+
+# Seconds between checks of the queue directory
+POLL_INTERVAL = 5.
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """
+    Write a file so that readers on any node see either nothing or the whole file
+
+    :param path: path of the file
+    :param data: content of the file
+    :return:
+    """
+
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    return None
+
+
+class WorkQueue(object):
+    """ WorkQueue class. """
+
+    def __init__(self, path: str) -> None:
+        """
+        This class is a work queue of fraction tasks in a shared directory. The coordinator writes one task file
+        per fraction; a worker claims a task by creating its lease file, keeps the lease fresh with heartbeats while
+        it runs, and writes a result (or error) file. A lease that is not refreshed within the lease timeout expires
+        and the task is claimed again by another worker.
+
+        :param path: queue directory, on a filesystem shared by the coordinator and the workers
+        """
+
+        self.path = path    # queue directory
+        self.tasks_dir = os.path.join(path, 'tasks')    # pickled (function, keyword arguments) of each task
+        self.leases_dir = os.path.join(path, 'leases')  # claimed tasks, with the claim token; mtime is the heartbeat
+        self.results_dir = os.path.join(path, 'results')    # pickled result of each finished task
+        self.errors_dir = os.path.join(path, 'errors')  # traceback of each failed task
+        self.claims = {}    # token of each task claimed through this object
+
+    @classmethod
+    def create(cls,
+               path: str,
+               lease_timeout: float = LEASE_TIMEOUT,
+               ) -> 'WorkQueue':
+        """
+        Create an empty queue for a new run, clearing the tasks and results of an earlier run in the same directory.
+        Tasks are named after the run, so results that workers of an earlier run write late are never taken.
+
+        :param path: queue directory
+        :param lease_timeout: seconds without a heartbeat after which a lease expires
+        :return: WorkQueue
+        """
+
+        queue = cls(path)
+
+        for directory in [queue.tasks_dir, queue.leases_dir, queue.results_dir, queue.errors_dir]:
+            os.makedirs(directory, exist_ok=True)
+            for filename in os.listdir(directory):
+                os.remove(os.path.join(directory, filename))
+
+        if os.path.exists(os.path.join(path, 'closed')):
+            os.remove(os.path.join(path, 'closed'))
+
+        _write_atomic(os.path.join(path, 'queue.json'),
+                      json.dumps({'run': uuid.uuid4().hex[:12], 'lease_timeout': lease_timeout}).encode())
+
+        return queue
+
+    @property
+    def exists(self) -> bool:
+        """ Whether a coordinator has created the queue """
+        return os.path.exists(os.path.join(self.path, 'queue.json'))
+
+    @property
+    def closed_run(self) -> str:
+        """ Id of the last run a coordinator has finished with, None if no run was closed """
+        try:
+            with open(os.path.join(self.path, 'closed'), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _config(self) -> dict:
+        with open(os.path.join(self.path, 'queue.json'), 'r') as f:
+            return json.load(f)
+
+    @property
+    def run_id(self) -> str:
+        """ Id of the current run of the queue, which starts the name of each of its tasks """
+        return self._config()['run']
+
+    @property
+    def lease_timeout(self) -> float:
+        """ Seconds without a heartbeat after which a lease expires """
+        return self._config()['lease_timeout']
+
+    def close(self, run_id: str = None) -> None:
+        """
+        Tell the workers of a run that no more tasks will come
+
+        :param run_id: id of the finished run [default: the current run]
+        :return:
+        """
+        _write_atomic(os.path.join(self.path, 'closed'), (run_id if run_id is not None else self.run_id).encode())
+        return None
+
+    def submit(self,
+               func,
+               jobs: list,
+               ) -> dict:
+        """
+        Write one task per fraction job, largest first, since workers claim the tasks in name order
+
+        :param func: fraction function, called with the keyword arguments of each job; must be importable by workers
+        :param jobs: list of scheduler.FractionJob
+        :return: dictionary of task name and file index
+        """
+
+        run_id = self.run_id
+
+        names = {}
+        for rank, job in enumerate(sorted(jobs, key=lambda j: j.cost, reverse=True)):
+            name = f'{run_id}_{rank:06d}_fraction_{job.idx}'
+            _write_atomic(os.path.join(self.tasks_dir, name), pickle.dumps((func, job.kwargs)))
+            names[name] = job.idx
+
+        return names
+
+    def _lease_path(self, name: str) -> str:
+        return os.path.join(self.leases_dir, name)
+
+    def holds_lease(self, name: str) -> bool:
+        """
+        Whether the lease of a task is still the one claimed through this object, i.e., it has not expired
+        and been claimed again by another worker
+
+        :param name: name of the claimed task
+        :return: whether the lease is held
+        """
+
+        try:
+            with open(self._lease_path(name), 'r') as f:
+                return json.load(f).get('token') == self.claims.get(name)
+        except (FileNotFoundError, ValueError):  # released, or being written by a new claim
+            return False
+
+    def claim(self,
+              worker_id: str,
+              logger: logging.Logger = None,
+              ) -> str:
+        """
+        Claim the first task that is neither finished nor leased, breaking expired leases
+
+        :param worker_id: id of the claiming worker
+        :param logger: logger
+        :return: name of the claimed task, or None if there is nothing to claim
+        """
+
+        logger = logger if logger else logging.getLogger(__name__)
+        lease_timeout = self.lease_timeout
+
+        for name in sorted(os.listdir(self.tasks_dir)):
+            if name.endswith('.tmp') or os.path.exists(os.path.join(self.results_dir, name)) \
+                    or os.path.exists(os.path.join(self.errors_dir, name)):
+                continue
+
+            lease_path = self._lease_path(name)
+
+            if os.path.exists(lease_path):
+                try:
+                    age = time.time() - os.path.getmtime(lease_path)
+                except FileNotFoundError:  # released in the meantime
+                    continue
+
+                if age < lease_timeout:
+                    continue
+
+                # Only one worker manages to move the expired lease away
+                try:
+                    expired_path = f'{lease_path}.{uuid.uuid4().hex}.expired'
+                    os.rename(lease_path, expired_path)
+                    os.remove(expired_path)
+                except FileNotFoundError:
+                    continue
+
+                logger.warning(f'Lease of {name} expired after {age:.0f} s without a heartbeat; retrying it')
+
+            # Claim the task by creating its lease; fails if another worker got there first
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+
+            token = f'{worker_id}-{uuid.uuid4().hex}'
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'worker': worker_id, 'token': token, 'claimed': time.time()}, f)
+
+            self.claims[name] = token
+
+            return name
+
+        return None
+
+    def run(self,
+            name: str,
+            logger: logging.Logger = None,
+            ) -> bool:
+        """
+        Run a claimed task while keeping its lease fresh, then write its result or error and release the lease.
+        A worker whose lease expired and was claimed by another worker leaves the new lease alone;
+        the task then runs twice and both runs write the same result. The result of a task from a run that a
+        coordinator has since replaced is dropped.
+
+        :param name: name of the claimed task
+        :param logger: logger
+        :return: whether the task succeeded and its result was kept
+        """
+
+        logger = logger if logger else logging.getLogger(__name__)
+        lease_path = self._lease_path(name)
+
+        stop = threading.Event()
+
+        def heartbeat() -> None:
+            """ refresh the lease until the task is finished, or until the lease is lost """
+            while not stop.wait(self.lease_timeout / 5):
+                if not self.holds_lease(name):
+                    logger.warning(f'Lost the lease of {name} to another worker')
+                    return
+                try:
+                    os.utime(lease_path)
+                except FileNotFoundError:
+                    return
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+
+        try:
+            with open(os.path.join(self.tasks_dir, name), 'rb') as f:
+                func, kwargs = pickle.load(f)
+
+            output = pickle.dumps(func(**kwargs))
+            output_dir = self.results_dir
+            succeeded = True
+
+        except Exception:
+            output = traceback.format_exc().encode()
+            output_dir = self.errors_dir
+            succeeded = False
+
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+
+        # A coordinator may have started a new run in the queue directory while the task ran
+        if not name.startswith(f'{self.run_id}_'):
+            logger.warning(f'Dropping the {"result" if succeeded else "error"} of {name} from an earlier run')
+            self.claims.pop(name, None)
+            return False
+
+        if not succeeded:
+            logger.error(f'[error] task {name} failed')
+        _write_atomic(os.path.join(output_dir, name), output)
+
+        if self.holds_lease(name):
+            os.remove(lease_path)
+        self.claims.pop(name, None)
+
+        return succeeded
+
+    def wait(self,
+             names: list,
+             poll_interval: float = POLL_INTERVAL,
+             timeout: float = None,
+             logger: logging.Logger = None,
+             ) -> dict:
+        """
+        Wait for the results of the tasks, warning when no worker has claimed a task within the lease timeout
+
+        :param names: names of the tasks
+        :param poll_interval: seconds between checks of the queue directory
+        :param timeout: seconds to wait before giving up, None to wait until all tasks are finished
+        :param logger: logger
+        :return: dictionary of task name and result
+        """
+
+        logger = logger if logger else logging.getLogger(__name__)
+        start = time.monotonic()
+        n_finished = -1
+        claimed = False
+        lease_timeout = self.lease_timeout
+
+        while True:
+            for name in names:
+                error_path = os.path.join(self.errors_dir, name)
+                if os.path.exists(error_path):
+                    with open(error_path, 'r') as f:
+                        raise RuntimeError(f'[error] task {name} failed on a worker:\n{f.read()}')
+
+            finished = [name for name in names if os.path.exists(os.path.join(self.results_dir, name))]
+
+            if len(finished) != n_finished:
+                n_finished = len(finished)
+                logger.info(f'{n_finished} of {len(names)} fractions finished, '
+                            f'{len(os.listdir(self.leases_dir))} running')
+
+            if n_finished == len(names):
+                break
+
+            claimed = claimed or n_finished > 0 or len(os.listdir(self.leases_dir)) > 0
+            if not claimed and time.monotonic() - start > lease_timeout:
+                logger.warning(f'No worker has claimed a fraction in {lease_timeout:.0f} s; '
+                               f'start workers with: pytmt worker {self.path}')
+                claimed = True  # warn once
+
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'[error] {len(names) - n_finished} fractions did not finish within {timeout} s')
+
+            time.sleep(poll_interval)
+
+        results = {}
+        for name in names:
+            with open(os.path.join(self.results_dir, name), 'rb') as f:
+                results[name] = pickle.load(f)
+
+        return results
+
+
+def run_queue(func,
+              jobs: list,
+              queue_dir: str,
+              lease_timeout: float = LEASE_TIMEOUT,
+              poll_interval: float = POLL_INTERVAL,
+              timeout: float = None,
+              logger: logging.Logger = None,
+              ) -> dict:
+    """
+    Run the fraction function over all fraction jobs on the workers of a queue directory,
+    as the coordinator of the queue
+
+    :param func: fraction function, called with the keyword arguments of each job
+    :param jobs: list of scheduler.FractionJob
+    :param queue_dir: queue directory, on a filesystem shared with the workers
+    :param lease_timeout: seconds without a heartbeat after which a fraction is retried
+    :param poll_interval: seconds between checks of the queue directory
+    :param timeout: seconds to wait for the fractions before giving up, None to wait until all are finished
+    :param logger: logger
+    :return: dictionary of file index and the result of the fraction function
+    """
+
+    logger = logger if logger else logging.getLogger(__name__)
+
+    queue = WorkQueue.create(queue_dir, lease_timeout=lease_timeout)
+    run_id = queue.run_id
+    names = queue.submit(func, jobs)
+    logger.info(f'Queued {len(names)} fractions in {queue_dir}; start workers with: pytmt worker {queue_dir}')
+
+    try:
+        results = queue.wait(list(names), poll_interval=poll_interval, timeout=timeout, logger=logger)
+    finally:
+        queue.close(run_id)
+
+    return {names[name]: result for name, result in results.items()}
+
+
+def work(queue_dir: str,
+         poll_interval: float = POLL_INTERVAL,
+         idle_timeout: float = None,
+         logger: logging.Logger = None,
+         ) -> int:
+    """
+    Claim and run the tasks of a queue until the coordinator closes the current run. A run that was already
+    closed when the worker started is left from an earlier coordinator, and the worker waits for the next run.
+
+    :param queue_dir: queue directory
+    :param poll_interval: seconds between checks of the queue directory
+    :param idle_timeout: stop after this many seconds without a task, None to wait until the queue is closed
+    :param logger: logger
+    :return: number of tasks run
+    """
+
+    logger = logger if logger else logging.getLogger(__name__)
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    queue = WorkQueue(queue_dir)
+    stale_run = queue.closed_run    # closed before the worker started
+
+    n_run = 0
+    idle_since = time.monotonic()
+
+    while True:
+        name = queue.claim(worker_id, logger=logger) if queue.exists else None
+
+        if name is None:
+            closed_run = queue.closed_run
+            if (closed_run is not None and closed_run != stale_run and queue.exists and closed_run == queue.run_id) \
+                    or (idle_timeout is not None and time.monotonic() - idle_since > idle_timeout):
+                break
+            time.sleep(poll_interval)
+            continue
+
+        logger.info(f'Worker {worker_id} claimed {name}')
+        queue.run(name, logger=logger)
+        n_run += 1
+        idle_since = time.monotonic()
+
+    logger.info(f'Worker {worker_id} finished after {n_run} tasks')
+
+    return n_run
+
+
+def main(argv: list = None) -> None:
+    """
+    Entry point of pytmt worker
+
+    :param argv: command line arguments after 'worker'
+    :return:
+    """
+
+    parser = argparse.ArgumentParser(prog='pytmt worker',
+                                     description='pytmt worker quantifies the fractions queued by pytmt --queue '
+                                                 'in a directory shared between nodes',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     )
+
+    parser.add_argument('queue', help='<required> queue directory given to pytmt --queue')
+
+    parser.add_argument('--poll-interval', help='seconds between checks of the queue directory',
+                        type=float, default=POLL_INTERVAL)
+
+    parser.add_argument('--idle-timeout', help='stop after this many seconds without a fraction '
+                                               '[default: run until the queue is closed]',
+                        type=float)
+
+    parser.add_argument('-v', '--version', action='version',
+                        version='pyTMT {version}'.format(version=__version__))
+
+    args = parser.parse_args(argv)
+
+    log_dir = os.path.join(args.queue, 'logs', f'{socket.gethostname()}-{os.getpid()}')
+    os.makedirs(log_dir, exist_ok=True)
+    logger = get_logger('pytmt', log_dir)
+    logger.info(args)
+    logger.info(__version__)
+
+    work(args.queue, poll_interval=args.poll_interval, idle_timeout=args.idle_timeout, logger=logger)
+
+    return None
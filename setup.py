@@ -47,7 +47,10 @@ setup(
 
     keywords='scientific proteomics mass-spectrometry',  # Optional
 
-    packages=find_packages(),
+    # The contaminant matrices in contams/ are installed as pytmt/contams
+    packages=find_packages() + ['pytmt.contams'],
+    package_dir={'pytmt.contams': 'contams'},
+    package_data={'pytmt.contams': ['*.csv']},
 
     python_requires='>=3.6, <4',
 
@@ -59,6 +62,9 @@ setup(
     entry_points={
         'console_scripts': [
             'pytmt=pytmt.__main__:main',
+            'pytmt-normalize=pytmt.normalize:main',
+            'pytmt-server=pytmt.server:main',
+            'pytmt-client=pytmt.server:client',
         ],
     },
 
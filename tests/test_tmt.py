@@ -4,10 +4,108 @@
 
 import unittest
 import os
+import sys
+import time
+import subprocess
+import base64
+import zlib
 import ftplib
+import tempfile
+import threading
+import socket
+import unittest.mock
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from pytmt.get_spec import Mzml
+from pytmt import get_spec
+from pytmt import scheduler
+from pytmt import workqueue
+from pytmt import quantify_spec
+from pytmt import correct_matrix
+from pytmt import tmt_reporters
+from pytmt.tmt_reporters import ReporterPanel
+from pytmt.normalize import PlexMatrix
+from pytmt import server
+import pytmt
+
+
+def _binary_array(values, name, accession, float_type):
+    """ Encode a zlib compressed binary data array """
+    dtype, type_accession = {'64-bit float': (np.float64, 'MS:1000523'),
+                             '32-bit float': (np.float32, 'MS:1000521')}[float_type]
+    encoded = base64.b64encode(zlib.compress(np.asarray(values, dtype=dtype).tobytes())).decode()
+
+    return (f'<binaryDataArray encodedLength="{len(encoded)}">'
+            f'<cvParam cvRef="MS" accession="{type_accession}" name="{float_type}"/>'
+            f'<cvParam cvRef="MS" accession="MS:1000574" name="zlib compression"/>'
+            f'<cvParam cvRef="MS" accession="{accession}" name="{name}"/>'
+            f'<binary>{encoded}</binary></binaryDataArray>')
+
+
+def write_test_mzml(path, spectra, spectrum_type='centroid spectrum', tic=None):
+    """
+    Write a minimal mzML file
+
+    :param path: path of the mzML file
+    :param spectra: list of (ms level, mz list, intensity list, precursor scan or None)
+    :param spectrum_type: 'centroid spectrum' or 'profile spectrum'
+    :param tic: total ion current written as the TIC cvParam of every spectrum, None to leave it out
+    """
+    accession = {'centroid spectrum': 'MS:1000127', 'profile spectrum': 'MS:1000128'}[spectrum_type]
+    tic_param = '' if tic is None else \
+        f'<cvParam cvRef="MS" accession="MS:1000285" name="total ion current" value="{tic}"/>'
+
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">',
+             '<cvList count="1"><cv id="MS" fullName="PSI-MS" version="4.1.30" URI="ms"/></cvList>',
+             f'<run id="test"><spectrumList count="{len(spectra)}">']
+
+    for i, (ms_level, mz_values, intensities, precursor) in enumerate(spectra):
+        precursor_list = ''
+        if precursor is not None:
+            precursor_list = (f'<precursorList count="1">'
+                              f'<precursor spectrumRef="controllerType=0 controllerNumber=1 scan={precursor}">'
+                              f'<selectedIonList count="1"><selectedIon>'
+                              f'<cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="500.0"/>'
+                              f'</selectedIon></selectedIonList></precursor></precursorList>')
+
+        lines.append(f'<spectrum index="{i}" id="controllerType=0 controllerNumber=1 scan={i + 1}" '
+                     f'defaultArrayLength="{len(mz_values)}">'
+                     f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>'
+                     f'<cvParam cvRef="MS" accession="{accession}" name="{spectrum_type}"/>{tic_param}'
+                     f'<scanList count="1"><scan>'
+                     f'<cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="{i * 0.1}" '
+                     f'unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"/>'
+                     f'</scan></scanList>{precursor_list}'
+                     f'<binaryDataArrayList count="2">'
+                     f'{_binary_array(mz_values, "m/z array", "MS:1000514", "64-bit float")}'
+                     f'{_binary_array(intensities, "intensity array", "MS:1000515", "32-bit float")}'
+                     f'</binaryDataArrayList></spectrum>')
+
+    lines.append('</spectrumList></run></mzML>')
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+class FractionFilesMixin(object):
+    """
+    Writes three fractions of 2, 8 and 4 ms2 spectra for the tests that schedule or queue fractions
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for n_spectra in [2, 8, 4]:
+            path = os.path.join(self.tmp_dir.name, f'fraction_{n_spectra}.mzML')
+            write_test_mzml(path, [(2, [126.1277], [10.0], 1)] * n_spectra)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
 
 class MzmlTest(unittest.TestCase):
     """
@@ -92,3 +190,708 @@ class MzmlTest(unittest.TestCase):
         self.assertEqual(len(file_indices), 2)
 
 
+
+
+class MzmlParseTest(unittest.TestCase):
+    """
+    Test cases involving decoding spectra from a small synthetic mzML file
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'test.mzML')
+
+        rng = np.random.default_rng(1)
+        spectra = []
+        for i in range(40):
+            if i % 4 == 0:
+                spectra.append((1, [400.0, 500.0, 600.0], [1e4, 2e4, 3e4], None))
+            else:
+                mz_values = np.sort(np.concatenate([[126.1277, 127.1248, 131.1382], rng.uniform(150, 1500, 50)]))
+                spectra.append((2, mz_values, rng.uniform(1, 1e3, len(mz_values)), i // 4 * 4 + 1))
+
+        write_test_mzml(self.path, spectra)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_that_threaded_decoding_matches_sequential(self):
+        """
+        Check that the threaded pipeline returns the same reduced spectra and tic in scan order
+        """
+
+        sequential = Mzml(self.path)
+        sequential.parse_mzml_ms2(mz_range=(126.0, 132.0))
+
+        threaded = Mzml(self.path)
+        threaded.parse_mzml_ms2(mz_range=(126.0, 132.0), threads=4)
+
+        self.assertEqual(list(threaded.ms2data), list(sequential.ms2data))
+        self.assertEqual(len(threaded.ms2data), 30)
+        self.assertEqual(threaded.prec_idx, sequential.prec_idx)
+
+        for scan, peaks in sequential.ms2data.items():
+            np.testing.assert_array_equal(threaded.ms2data[scan], peaks)
+            self.assertEqual(len(peaks), 3)
+            self.assertAlmostEqual(threaded.tic_idx[scan], sequential.tic_idx[scan])
+
+    def test_that_precursor_purity_is_read_from_preceding_ms1(self):
+        """
+        Check the precursor isolation purity of ms2 scans against a doubly charged isotope envelope and an interferer
+        """
+
+        path = os.path.join(self.tmp_dir.name, 'purity.mzML')
+        write_test_mzml(path, [(1, [499.0, 500.0, 500.2, 500.501678, 501.003355], [1e3, 100.0, 50.0, 50.0, 25.0], None),
+                               (2, [126.1277], [10.0], 1),
+                               (1, [500.0], [100.0], None),
+                               (2, [126.1277], [10.0], 3),
+                               ])
+
+        mzml = Mzml(path, precision=10)
+        mzml.parse_mzml_ms2(ms1=True, threads=2)
+
+        self.assertEqual(mzml.ms1data, {})
+        np.testing.assert_array_equal(mzml.ms1index.preceding([1, 2, 3, 4]), [0, 0, 1, 1])
+
+        purity = mzml.ms1index.purity(scans=[2, 4, 2],
+                                      mz=[500.0, 500.0, 505.0],
+                                      charge=[2, 2, 2],
+                                      isolation_width=1.2,
+                                      precision=10,
+                                      )
+
+        # 501.003 is outside of the isolation window and 499.0 outside of the envelope
+        np.testing.assert_allclose(purity, [0.75, 1.0, np.nan])
+
+    def test_that_profile_centroiding_matches_pymzml(self):
+        """
+        Check that the numpy centroiding of profile spectra matches pymzml, and that profile areas are integrated
+        """
+
+        path = os.path.join(self.tmp_dir.name, 'profile.mzML')
+
+        reporters = [126.127726, 127.124761, 127.131081]
+        mz_values, intensities = [], []
+        for reporter, height in zip(reporters, [1e3, 2e3, 4e3]):
+            sigma = reporter * 5e-6
+            x = np.arange(reporter - 4 * sigma, reporter + 4 * sigma, sigma / 3) + sigma / 7
+            mz_values.append(x)
+            intensities.append(height * np.exp(-(x - reporter) ** 2 / (2 * sigma ** 2)) + 1.0)
+
+        write_test_mzml(path, [(2, np.concatenate(mz_values), np.concatenate(intensities), 1)],
+                        spectrum_type='profile spectrum')
+
+        centroided = {}
+        for profile in ['pymzml', 'gaussian', 'area']:
+            centroided[profile] = Mzml(path)
+            centroided[profile].parse_mzml_ms2(mz_range=(126.0, 128.0), profile=profile)
+
+        np.testing.assert_allclose(centroided['gaussian'].ms2data[1], centroided['pymzml'].ms2data[1])
+        np.testing.assert_allclose(centroided['gaussian'].ms2data[1][:, 0], reporters, rtol=1e-7)
+        self.assertAlmostEqual(centroided['gaussian'].tic_idx[1],
+                               np.concatenate(intensities).astype(np.float32).sum(), places=0)
+
+        # A range edge through a peak fits the same centroids as the full spectrum
+        upper = reporters[1] * (1 + 1e-6)
+        full = get_spec.centroid_profile(np.concatenate(mz_values), np.concatenate(intensities).astype(np.float32))
+        edge = Mzml(path)
+        edge.parse_mzml_ms2(mz_range=(126.0, upper), profile='gaussian')
+        np.testing.assert_allclose(edge.ms2data[1], full[full[:, 0] <= upper])
+        self.assertEqual(len(edge.ms2data[1]), 2)
+
+        # The total ion current recorded by the instrument is kept
+        write_test_mzml(path, [(2, np.concatenate(mz_values), np.concatenate(intensities), 1)],
+                        spectrum_type='profile spectrum', tic=1e6)
+        recorded = Mzml(path)
+        recorded.parse_mzml_ms2(mz_range=(126.0, 128.0), profile='gaussian')
+        self.assertEqual(recorded.tic_idx[1], 1e6)
+        self.assertTrue(centroided['area'].profile_idx[1])
+
+        # The area of a gaussian is its height * sigma * sqrt(2 * pi)
+        tmt_intensities = quantify_spec.quantify_reporters(idx=0,
+                                                           scan=1,
+                                                           spectrum=centroided['area'].ms2data[1],
+                                                           precision=40,
+                                                           reporters=reporters,
+                                                           digits=4,
+                                                           area=True,
+                                                           )
+        np.testing.assert_allclose(tmt_intensities[2:5],
+                                   [h * r * 5e-6 * np.sqrt(2 * np.pi) for r, h in zip(reporters, [1e3, 2e3, 4e3])],
+                                   rtol=0.05)
+
+
+def _square(x):
+    """ Fraction function for the scheduler tests """
+    return [x * x]
+
+
+def _square_or_die(x, marker=None):
+    """ Fraction function for the scheduler tests; its worker is killed unless the marker file exists """
+    if marker is not None and not os.path.exists(marker):
+        if not marker.endswith('never'):
+            open(marker, 'w').close()
+        os.kill(os.getpid(), 9)
+    return [x * x]
+
+
+class SchedulerTest(FractionFilesMixin, unittest.TestCase):
+    """
+    Test cases involving scheduling fractions over worker processes
+    """
+
+    def test_that_spectrum_count_is_read_from_mzml(self):
+        """
+        Check that the spectrum count is read from the head of the mzML file
+        """
+
+        self.assertEqual([scheduler.get_spectrum_count(path) for path in self.paths], [2, 8, 4])
+
+    def test_that_fractions_run_under_memory_limit(self):
+        """
+        Check that all fractions return their result, largest first, with and without worker processes
+        """
+
+        jobs = [scheduler.FractionJob(idx=i, mzml_path=path, n_psms=10, kwargs={'x': i})
+                for i, path in enumerate(self.paths)]
+
+        self.assertEqual([job.idx for job in sorted(jobs, key=lambda job: job.cost, reverse=True)], [1, 2, 0])
+
+        sequential = scheduler.run_fractions(_square, jobs)
+        parallel = scheduler.run_fractions(_square, jobs, workers=2, memory_limit=1.)
+
+        self.assertEqual(sequential, {0: [0], 1: [1], 2: [4]})
+        self.assertEqual(parallel, sequential)
+        self.assertEqual(scheduler.run_fractions(_square, jobs, workers=0, memory_limit=1000.), sequential)
+
+    def test_that_killed_workers_are_retried_or_reported(self):
+        """
+        Check that a fraction whose worker is killed is retried on its own, and fails clearly if it is killed again
+        """
+
+        jobs = [scheduler.FractionJob(idx=i, mzml_path=path, n_psms=10, kwargs={'x': i})
+                for i, path in enumerate(self.paths)]
+
+        jobs[1].kwargs['marker'] = os.path.join(self.tmp_dir.name, 'killed_once')
+        self.assertEqual(scheduler.run_fractions(_square_or_die, jobs, workers=2, memory_limit=1e4),
+                         {0: [0], 1: [1], 2: [4]})
+
+        jobs[1].kwargs['marker'] = os.path.join(self.tmp_dir.name, 'killed_never')
+        with self.assertRaisesRegex(RuntimeError, 'fraction 1 died'):
+            scheduler.run_fractions(_square_or_die, jobs, workers=2, memory_limit=1e4)
+
+
+class WorkQueueTest(FractionFilesMixin, unittest.TestCase):
+    """
+    Test cases involving fractions distributed to pytmt worker processes through a queue directory
+    """
+
+    def test_that_workers_finish_fractions_and_retry_expired_leases(self):
+        """
+        Check that workers return all fraction results, including one claimed by a worker that stopped heartbeating
+        """
+
+        queue_dir = os.path.join(self.tmp_dir.name, 'queue')
+        jobs = [scheduler.FractionJob(idx=i, mzml_path=path, n_psms=10, kwargs={'path': path})
+                for i, path in enumerate(self.paths)]
+
+        queue = workqueue.WorkQueue.create(queue_dir, lease_timeout=1.)
+        names = queue.submit(scheduler.get_spectrum_count, jobs)
+
+        # The largest fraction is claimed by a worker that never finishes it
+        self.assertEqual(queue.claim('lost-worker'), f'{queue.run_id}_000000_fraction_1')
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        workers = [subprocess.Popen([sys.executable, '-m', 'pytmt', 'worker', queue_dir,
+                                     '--poll-interval', '0.1', '--idle-timeout', '30'],
+                                    cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                   for _ in range(2)]
+
+        try:
+            results = queue.wait(list(names), poll_interval=0.1, timeout=30)
+        finally:
+            queue.close()
+            for worker in workers:
+                worker.wait(timeout=30)
+
+        self.assertEqual({names[name]: result for name, result in results.items()}, {0: 2, 1: 8, 2: 4})
+        self.assertEqual(os.listdir(queue.leases_dir), [])
+
+    def test_that_workers_started_early_wait_for_the_next_run(self):
+        """
+        Check that a worker started before the coordinator ignores the closed marker of the earlier run
+        """
+
+        queue_dir = os.path.join(self.tmp_dir.name, 'queue')
+        jobs = [scheduler.FractionJob(idx=i, mzml_path=path, n_psms=10, kwargs={'path': path})
+                for i, path in enumerate(self.paths)]
+
+        # An earlier run left its queue closed
+        workqueue.WorkQueue.create(queue_dir).close()
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        worker = subprocess.Popen([sys.executable, '-m', 'pytmt', 'worker', queue_dir,
+                                   '--poll-interval', '0.1', '--idle-timeout', '30'],
+                                  cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(1)
+
+        try:
+            results = workqueue.run_queue(scheduler.get_spectrum_count, jobs, queue_dir, poll_interval=0.1, timeout=30)
+        finally:
+            worker.wait(timeout=30)
+
+        self.assertEqual(results, {0: 2, 1: 8, 2: 4})
+
+    def test_that_stale_workers_leave_new_leases_alone(self):
+        """
+        Check that a worker whose lease expired and was claimed again does not release the new lease
+        """
+
+        queue_dir = os.path.join(self.tmp_dir.name, 'queue')
+        jobs = [scheduler.FractionJob(idx=0, mzml_path=self.paths[0], n_psms=10, kwargs={'path': self.paths[0]})]
+
+        workqueue.WorkQueue.create(queue_dir, lease_timeout=60.).submit(scheduler.get_spectrum_count, jobs)
+
+        stale, current = workqueue.WorkQueue(queue_dir), workqueue.WorkQueue(queue_dir)
+        name = stale.claim('stale-worker')
+
+        # The stale worker stops heartbeating, and its lease expires
+        os.utime(stale._lease_path(name), (time.time() - 120, time.time() - 120))
+        self.assertEqual(current.claim('current-worker'), name)
+
+        self.assertFalse(stale.holds_lease(name))
+        self.assertTrue(stale.run(name))
+        self.assertTrue(current.holds_lease(name))
+
+        self.assertTrue(current.run(name))
+        self.assertEqual(os.listdir(current.leases_dir), [])
+
+    def test_that_results_of_earlier_runs_are_dropped(self):
+        """
+        Check that a worker still running a task of an earlier run does not write into a new run
+        """
+
+        queue_dir = os.path.join(self.tmp_dir.name, 'queue')
+        jobs = [scheduler.FractionJob(idx=0, mzml_path=self.paths[0], n_psms=10, kwargs={'path': self.paths[0]})]
+
+        first = workqueue.WorkQueue.create(queue_dir)
+        first_names = first.submit(scheduler.get_spectrum_count, jobs)
+        stale = workqueue.WorkQueue(queue_dir)
+        stale_name = stale.claim('stale-worker')
+
+        # A new coordinator starts over in the same directory before the stale worker finishes
+        second = workqueue.WorkQueue.create(queue_dir)
+        second_names = second.submit(scheduler.get_spectrum_count, jobs)
+
+        self.assertNotEqual(list(first_names), list(second_names))
+        self.assertFalse(stale.run(stale_name))
+        self.assertEqual(os.listdir(second.results_dir) + os.listdir(second.errors_dir), [])
+
+
+class QuantifyReportersTest(unittest.TestCase):
+    """
+    Test cases involving integrating reporter intensities
+    """
+
+    def test_that_reporter_qc_is_returned_with_intensities(self):
+        """
+        Check the reporter intensities and qc metrics of a spectrum with one missing channel
+        """
+
+        reporters = [126.127726, 127.124761, 127.131081]
+        spectrum = [[126.127726 * (1 + 2e-6), 100.0],
+                    [127.124761, 300.0],
+                    [127.124761 * (1 + 20e-6), 50.0],
+                    [500.0, 550.0]]
+
+        tmt_intensities = quantify_spec.quantify_reporters(idx=0,
+                                                           scan=10,
+                                                           spectrum=spectrum,
+                                                           precision=10,
+                                                           reporters=reporters,
+                                                           noise=50.0,
+                                                           qc=True,
+                                                           )
+
+        self.assertEqual(tmt_intensities[:6], [0, 10, 100.0, 300.0, 0.0, 1000.0])
+        reporter_sn, missing_channels, reporter_tic_fraction, reporter_ppm_error = tmt_intensities[6:]
+        self.assertEqual(reporter_sn, 8.0)
+        self.assertEqual(missing_channels, 1)
+        self.assertEqual(reporter_tic_fraction, 0.4)
+        self.assertAlmostEqual(reporter_ppm_error, 0.5, places=2)
+
+    def test_that_profile_area_allows_empty_high_channels(self):
+        """
+        Check the profile area of a reporter when the higher reporter windows lie above the last profile point
+        """
+
+        spectrum = [[126.1270, 10.0], [126.127726, 30.0], [126.1285, 10.0]]
+
+        tmt_intensities = quantify_spec.quantify_reporters(idx=0,
+                                                           scan=10,
+                                                           spectrum=spectrum,
+                                                           precision=100,
+                                                           reporters=tmt_reporters.get_reporters(10),
+                                                           area=True,
+                                                           )
+
+        # Two trapezoids of (0.000726 + 0.000774) m/z x 40 / 2 in 126, nothing in the other nine channels
+        self.assertAlmostEqual(tmt_intensities[2], 0.03)
+        self.assertEqual(tmt_intensities[3:12], [0.0] * 9)
+        self.assertEqual(tmt_intensities[12], 50.0)
+
+
+class ReporterPanelTest(unittest.TestCase):
+    """
+    Test cases involving compiled reporter panels
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_that_panel_files_are_sorted_and_checked_for_collisions(self):
+        """
+        Check that a custom panel file is read in m/z order with its windows, and that overlapping windows are found
+        """
+
+        path = os.path.join(self.tmp_dir.name, 'panel.csv')
+        with open(path, 'w') as f:
+            f.write('channel,mz\n# custom panel\n135D,135.1580\n126,126.127726\n135N,135.151600\n')
+
+        panel = ReporterPanel.from_file(path, precision=10)
+
+        self.assertEqual(panel.names, ['126', '135N', '135D'])
+        self.assertEqual(panel.columns, ['m126', 'm135N', 'm135D'])
+        self.assertEqual(list(panel), [126.127726, 135.1516, 135.158])
+        self.assertAlmostEqual(panel.lower[0], 126.127726 * (1 - 5e-6))
+        self.assertEqual(panel.collisions(), [])
+        self.assertEqual(panel.with_precision(100).collisions(), [('135N', '135D')])
+
+        self.assertEqual(ReporterPanel.load(10).names[-1], '131N')
+        self.assertEqual(ReporterPanel.load(10, precision=20).columns[-1], 'm131.13818')
+        self.assertEqual(ReporterPanel.from_file(path).with_precision(20).columns, panel.columns)
+        self.assertEqual(list(ReporterPanel.load(6, precision=20)), tmt_reporters.get_reporters(6))
+
+    def test_that_panels_quantify_like_reporter_lists(self):
+        """
+        Check that a panel gives the intensities of the list of its reporters, including overlapping windows
+        """
+
+        spectrum = [[126.127726, 10.0], [127.124761, 20.0], [127.128, 5.0], [127.131081, 40.0], [128.5, 7.0]]
+
+        for precision in [10, 100]:
+            reporters = tmt_reporters.get_reporters(10)
+            panel = ReporterPanel.load(10, precision=precision)
+
+            from_list = quantify_spec.quantify_reporters(0, 1, spectrum, precision, reporters, qc=True)
+            from_panel = quantify_spec.quantify_reporters(0, 1, spectrum, None, panel, qc=True)
+
+            self.assertEqual(from_panel, from_list)
+
+        # At 100 ppm, the windows of 127N and 127C both hold the peaks of 127N, 127C and the one in between
+        self.assertEqual(from_panel[2:6], [10.0, 65.0, 65.0, 0.0])
+
+
+    def test_that_contaminant_matrices_follow_the_panel_channels(self):
+        """
+        Check that a labelled contaminant matrix is reordered to the channels of a panel, and rejected if they differ
+        """
+
+        output_df = pd.DataFrame([[0, 2, 100.0, 20.0, 125.0]],
+                                 columns=['file_idx', 'scan', 'm126', 'm127N', 'spectrum_int'])
+        contam = pd.DataFrame([[0.9, 0.1], [0.1, 0.9]],
+                              index=['obs_126', ' obs_127N'], columns=['tru_126', 'tru_127N'])
+
+        # The same matrix with its rows and columns listed in another order corrects the same way
+        in_order = correct_matrix.correct_matrix(output_df, contam, nnls=False, channels=['126', '127N'])
+        shuffled = correct_matrix.correct_matrix(output_df, contam.iloc[::-1, ::-1], nnls=False,
+                                                 channels=['126', '127N'])
+
+        np.testing.assert_allclose(in_order[['m126_cor', 'm127N_cor']].iloc[0], [110.0, 10.0])
+        pd.testing.assert_frame_equal(shuffled, in_order)
+
+        with self.assertRaisesRegex(AssertionError, 'do not match the reporter channels'):
+            correct_matrix.correct_matrix(output_df, contam, nnls=False, channels=['126', '127C'])
+
+
+class ApiTest(unittest.TestCase):
+    """
+    Test cases involving the library interface with psms and spectra in memory
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for n, scale in enumerate([1.0, 10.0]):
+            path = os.path.join(self.tmp_dir.name, f'frac_{n}.mzML')
+            write_test_mzml(path, [(1, [400.0, 500.0], [1e4, 2e4], None),
+                                   (2, [126.127726, 127.131081, 300.0], [100.0 * scale, 20.0 * scale, 5.0], 1),
+                                   ])
+            self.paths.append(path)
+
+        self.psms = pd.DataFrame({'file_idx': [0, 1],
+                                  'scan': [2, 2],
+                                  'percolator q-value': [0.001, 0.001],
+                                  'protein id': ['sp|P1|A', 'sp|P2|B'],
+                                  'sequence': ['PEPTIDE', 'PEPTIDES'],
+                                  })
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_that_frames_are_returned_without_writing(self):
+        """
+        Check that psms in a data frame, paths and opened spectra, and a contaminant array give the result tables
+        """
+
+        contam = np.array([[0.9, 0.1], [0.1, 0.9]])
+
+        psm_df, protein_df = pytmt.quantify(psms=self.psms,
+                                            spectra={0: self.paths[0], 1: Mzml(self.paths[1])},
+                                            multiplex=2,
+                                            contam=contam,
+                                            )
+
+        self.assertEqual(list(psm_df['m126.127726']), [100.0, 1000.0])
+        self.assertEqual(list(psm_df['spectrum_int']), [125.0, 1205.0])
+
+        # 0.9 * a + 0.1 * b = 100, 0.1 * a + 0.9 * b = 20
+        np.testing.assert_allclose(protein_df.loc['sp|P1|A'], [110.0, 10.0])
+        np.testing.assert_allclose(protein_df.loc['sp|P2|B'], [1100.0, 100.0])
+
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ['frac_0.mzML', 'frac_1.mzML'])
+
+        with self.assertRaisesRegex(AssertionError, 'min_purity'):
+            pytmt.quantify(psms=self.psms, spectra={0: self.paths[0], 1: self.paths[1]}, min_purity=1.5)
+
+    def test_that_panel_channels_name_the_columns(self):
+        """
+        Check that a panel file out of m/z order names the output columns and is corrected with its labelled matrix
+        """
+
+        panel = os.path.join(self.tmp_dir.name, 'panel.csv')
+        with open(panel, 'w') as f:
+            f.write('127C,127.131081\n126,126.127726\n')
+
+        contam = pd.DataFrame([[0.9, 0.1], [0.1, 0.9]], index=['obs_127C', 'obs_126'], columns=['tru_127C', 'tru_126'])
+
+        psm_df, protein_df = pytmt.quantify(psms=self.psms,
+                                            spectra={0: self.paths[0], 1: self.paths[1]},
+                                            panel=panel,
+                                            contam=contam,
+                                            )
+
+        self.assertEqual(list(psm_df['m126']), [100.0, 1000.0])
+        self.assertEqual(list(protein_df.columns), ['m126_cor', 'm127C_cor'])
+        np.testing.assert_allclose(protein_df.loc['sp|P1|A'], [110.0, 10.0])
+
+
+class NormalizeTest(unittest.TestCase):
+    """
+    Test cases involving normalizing the protein intensities of multiple plexes
+    """
+
+    def test_that_plexes_are_aligned_and_irs_normalized(self):
+        """
+        Check that proteins are aligned over plexes and the bridge channels agree after normalization
+        """
+
+        plex1 = pd.DataFrame({'m126': [100.0, 200.0, 50.0], 'm127': [300.0, 400.0, 60.0]},
+                             index=pd.Index(['A', 'B', 'C'], name='protein id'))
+        plex2 = pd.DataFrame({'m126': [20.0, 10.0], 'm127': [90.0, 40.0]},
+                             index=pd.Index(['B', 'A'], name='protein id'))
+
+        matrix = PlexMatrix.from_tables([plex1, plex2], names=['plex1', 'plex2'])
+
+        self.assertEqual(list(matrix.proteins), ['A', 'B', 'C'])
+        np.testing.assert_array_equal(matrix.intensities[:, 2:], [[10.0, 40.0], [20.0, 90.0], [np.nan, np.nan]])
+
+        matrix.loading_normalize(method='sum')
+        self.assertEqual(len(set(np.round(np.nansum(matrix.intensities, axis=0), 6))), 1)
+
+        self.assertEqual(matrix.irs_normalize(bridge=['m127']), 1)
+        np.testing.assert_allclose(matrix.intensities[:2, 1], matrix.intensities[:2, 3])
+        self.assertTrue(np.isnan(matrix.intensities[2]).all())
+
+        self.assertEqual(list(matrix.to_frame().columns), ['plex1:m126', 'plex1:m127', 'plex2:m126', 'plex2:m127'])
+
+    def test_that_unused_channels_are_left_alone(self):
+        """
+        Check that channels without intensities keep their zeros and do not hide the bridge channels
+        """
+
+        proteins = pd.Index(['A', 'B', 'C'], name='protein id')
+        plex1 = pd.DataFrame({'m126': [100.0, 200.0, 50.0], 'm127': [300.0, 400.0, 60.0], 'm128': [0.0] * 3},
+                             index=proteins)
+        plex2 = pd.DataFrame({'m126': [20.0, 10.0, 5.0], 'm127': [90.0, 40.0, 30.0], 'm128': [0.0] * 3},
+                             index=proteins)
+
+        for method in ['median', 'sum']:
+            matrix = PlexMatrix.from_tables([plex1, plex2], names=['plex1', 'plex2'])
+            matrix.loading_normalize(method=method)
+
+            self.assertFalse(np.isnan(matrix.intensities).any())
+            np.testing.assert_array_equal(matrix.intensities[:, [2, 5]], 0.0)
+            self.assertEqual(matrix.irs_normalize(bridge=['m126']), 0)
+
+
+class StartupTest(unittest.TestCase):
+    """
+    Test cases involving the startup of the command line interface, which should not load the heavy dependencies
+    """
+
+    def run_python(self, *args):
+        """ Run python from the repository root and return the output """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, *args], cwd=root, capture_output=True, text=True, check=True)
+        return output.stdout.strip()
+
+    def test_that_cli_does_not_import_heavy_modules(self):
+        """
+        Check that importing the entry point does not import pandas, numpy, scipy, pymzml or tqdm
+        """
+
+        output = self.run_python('-c', 'import sys, pytmt.main; '
+                                          'print([m for m in ["pandas", "numpy", "scipy", "pymzml", "tqdm"] '
+                                          'if m in sys.modules])')
+
+        self.assertEqual(output, '[]')
+
+    def test_that_version_does_not_import_heavy_modules(self):
+        """
+        Check that pytmt --version and pytmt-normalize --version answer without importing pandas or numpy
+        """
+
+        for module in ['pytmt', 'pytmt.normalize']:
+            output = self.run_python('-c', 'import sys, runpy; sys.argv = ["pytmt", "--version"]\n'
+                                           f'try:\n    runpy.run_module("{module}", run_name="__main__")\n'
+                                           'except SystemExit:\n    pass\n'
+                                           'print("pandas" in sys.modules or "numpy" in sys.modules)')
+
+            self.assertTrue(output.startswith('pyTMT'))
+            self.assertTrue(output.endswith('False'))
+
+
+class ServerTest(unittest.TestCase):
+    """
+    Test cases involving quantification jobs sent to a running server
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp_dir.name, 'mzml'))
+
+        write_test_mzml(os.path.join(self.tmp_dir.name, 'mzml', 'frac.mzML'),
+                        [(1, [400.0, 500.0], [1e4, 2e4], None),
+                         (2, [126.127726, 127.124761, 300.0], [100.0, 200.0, 50.0], 1),
+                         (2, [126.127726, 127.124761, 300.0], [10.0, 20.0, 5.0], 1),
+                         ])
+
+        self.service = server.QuantService(workers=1, contams=None)
+        self.server = server._UnixServer(os.path.join(self.tmp_dir.name, 'pytmt.sock'), server._JobHandler)
+        self.server.service = self.service
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+        self.tmp_dir.cleanup()
+
+    def test_that_shipped_contaminant_matrices_are_loaded(self):
+        """
+        Check that the contaminant matrices shipped with pytmt are loaded by default, and that an empty directory warns
+        """
+
+        self.assertTrue(os.path.isfile(os.path.join(server.get_default_contams(), 'TA260585.csv')))
+        self.assertIn('TA260585', self.service.contams)
+
+        empty = os.path.join(self.tmp_dir.name, 'contams')
+        os.makedirs(empty)
+        with self.assertLogs(level='WARNING'):
+            service = server.QuantService(workers=1, contams=empty)
+        service.close()
+        self.assertEqual(service.contams, {})
+
+    def test_that_edited_contaminant_files_are_read_again(self):
+        """
+        Check that a contaminant matrix given as a path is read again after the file changes
+        """
+
+        path = os.path.join(self.tmp_dir.name, 'contam.csv')
+        pd.DataFrame([[1.0, 0.0], [0.0, 1.0]], index=['obs_126', 'obs_127C'],
+                     columns=['tru_126', 'tru_127C']).to_csv(path)
+        self.assertEqual(self.service.get_contam(path).iloc[0, 1], 0.0)
+        self.assertIs(self.service.get_contam(path), self.service.get_contam(path))
+
+        pd.DataFrame([[0.9, 0.1], [0.1, 0.9]], index=['obs_126', 'obs_127C'],
+                     columns=['tru_126', 'tru_127C']).to_csv(path)
+        os.utime(path, ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+        self.assertEqual(self.service.get_contam(path).iloc[0, 1], 0.1)
+
+    def test_that_sockets_are_private_and_not_taken_over(self):
+        """
+        Check that a live socket is left alone, that a stale one is replaced with a private socket,
+        and that tcp jobs need the token of the server
+        """
+
+        with self.assertRaisesRegex(RuntimeError, 'already listening'):
+            server._listen_unix(self.server.server_address)
+
+        stale_path = os.path.join(self.tmp_dir.name, 'stale.sock')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(stale_path)
+        stale.close()
+
+        replaced = server._listen_unix(stale_path)
+        replaced.server_close()
+        self.assertEqual(os.stat(stale_path).st_mode & 0o777, 0o600)
+
+        with unittest.mock.patch.dict(os.environ, {'XDG_RUNTIME_DIR': self.tmp_dir.name}):
+            tcp = server._listen_tcp(0)
+            port = tcp.server_address[1]
+            os.rename(server.get_token_path(0), server.get_token_path(port))
+            tcp.service = self.service
+            threading.Thread(target=tcp.serve_forever, daemon=True).start()
+
+            try:
+                job = {'mzml': os.path.join(self.tmp_dir.name, 'mzml'), 'psms': {}, 'multiplex': 2}
+                events = list(server.request(job, port=port, token='wrong'))
+                self.assertIn('token', events[-1]['message'])
+
+                self.assertEqual(os.stat(server.get_token_path(port)).st_mode & 0o777, 0o600)
+                events = list(server.request(job, port=port))
+                self.assertNotIn('token', events[-1]['message'])
+            finally:
+                tcp.shutdown()
+                tcp.server_close()
+
+    def test_that_jobs_stream_fractions_and_reuse_spectra(self):
+        """
+        Check that a job with an in-memory psm table streams its fraction and proteins, and that the spectra are cached
+        """
+
+        psms = pd.DataFrame({'file_idx': [0, 0],
+                             'scan': [2, 3],
+                             'percolator q-value': [0.001, 0.001],
+                             'protein id': ['sp|P1|A', 'sp|P1|A'],
+                             'sequence': ['PEPTIDE', 'PEPTIDES'],
+                             })
+
+        job = {'mzml': os.path.join(self.tmp_dir.name, 'mzml'),
+               'psms': psms.to_dict(orient='split'),
+               'multiplex': 2,
+               }
+
+        for cached in [False, True]:
+            events = list(server.request(job, socket_path=self.server.server_address))
+
+            self.assertEqual([event['event'] for event in events], ['fraction', 'done'])
+            self.assertEqual(events[0]['cached'], cached)
+            self.assertEqual(events[0]['rows'], [[0, 2, 100.0, 0.0, 350.0], [0, 3, 10.0, 0.0, 35.0]])
+
+            proteins = events[1]['protein_table']
+            self.assertEqual(proteins['data'], [['sp|P1|A', 110.0, 0.0]])